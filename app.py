@@ -1,55 +1,125 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS
-import json
+import atexit
+import click
+import functools
+import hashlib
+import heapq
 import os
-from datetime import datetime, timedelta
+import random
+from datetime import date, datetime, timedelta
+
+import assistant
+from cache import create_cache
+from passwords import PasswordHasher
+from store import DuplicateKeyError, Store, WriteBehind
+from tokens import TokenSigner, load_key
 
 app = Flask(__name__)
-CORS(app)
+CORS(app, expose_headers=['X-Next-Cursor'])
 
 # In a real application, you would use a proper database
-# For this demo, we'll use JSON files to simulate a database
-
-DATA_DIR = 'data'
-USERS_FILE = os.path.join(DATA_DIR, 'users.json')
-APPOINTMENTS_FILE = os.path.join(DATA_DIR, 'appointments.json')
-MEDICAL_RECORDS_FILE = os.path.join(DATA_DIR, 'medical_records.json')
-PERIOD_TRACKER_FILE = os.path.join(DATA_DIR, 'period_tracker.json')
-
-# Ensure data directory exists
-os.makedirs(DATA_DIR, exist_ok=True)
-
-# Initialize data files if they don't exist
-def init_data_files():
-    if not os.path.exists(USERS_FILE):
-        with open(USERS_FILE, 'w') as f:
-            json.dump([], f)
-    
-    if not os.path.exists(APPOINTMENTS_FILE):
-        with open(APPOINTMENTS_FILE, 'w') as f:
-            json.dump([], f)
-    
-    if not os.path.exists(MEDICAL_RECORDS_FILE):
-        with open(MEDICAL_RECORDS_FILE, 'w') as f:
-            json.dump([], f)
-    
-    if not os.path.exists(PERIOD_TRACKER_FILE):
-        with open(PERIOD_TRACKER_FILE, 'w') as f:
-            json.dump([], f)
-
-init_data_files()
-
-# Helper functions to read/write data
-def read_json(file_path):
-    try:
-        with open(file_path, 'r') as f:
-            return json.load(f)
-    except (json.JSONDecodeError, FileNotFoundError):
-        return []
-
-def write_json(file_path, data):
-    with open(file_path, 'w') as f:
-        json.dump(data, f, indent=2)
+# For this demo, we'll use JSON files to simulate a database.
+# The collections are loaded once at startup and served from memory.
+# By default every change is appended to a per-collection journal that is
+# periodically compacted back into the JSON file; set
+# MEDILINK_PERSISTENCE=snapshot to rewrite the JSON file on each change.
+# MEDILINK_SNAPSHOT_FORMAT=binary writes snapshots in a compact binary
+# format that loads much faster than the indented JSON, and
+# MEDILINK_RECORDS_STORAGE=mmap keeps medical records in a memory-mapped
+# record file that is decoded one patient at a time instead of in memory;
+# it is seeded once from the JSON collection, which isn't kept in sync.
+# MEDILINK_STORAGE=sqlite switches to the SQLite backend instead, which
+# imports the file-backed data the first time the database is created.
+# MEDILINK_CHAT_RESPONDER picks the chat responder from assistant.RESPONDERS.
+# Passwords are hashed with MEDILINK_PASSWORD_HASH (scrypt or pbkdf2_sha256)
+# at MEDILINK_PASSWORD_COST, see passwords.py; benchmark.py login helps pick
+# a cost.
+# Login issues a signed token (see tokens.py) valid for MEDILINK_TOKEN_TTL
+# seconds. Requests carrying it as "Authorization: Bearer <token>" may only
+# touch that user's data; MEDILINK_REQUIRE_TOKEN=1 rejects requests without
+# one.
+# Low-value updates such as last_login are queued and written in batches
+# every MEDILINK_WRITE_BEHIND_INTERVAL seconds and at shutdown; a crash loses
+# at most that interval of them. Set it to 0 to write them immediately.
+# MEDILINK_CACHE selects the response cache backend (memory, redis or none),
+# sized by MEDILINK_CACHE_SIZE or pointed at MEDILINK_CACHE_URL.
+
+DATA_DIR = os.environ.get('MEDILINK_DATA_DIR', 'data')
+STORAGE = os.environ.get('MEDILINK_STORAGE', 'json')
+PERSISTENCE = os.environ.get('MEDILINK_PERSISTENCE', 'journal')
+JOURNAL_FSYNC = os.environ.get('MEDILINK_JOURNAL_FSYNC', '0') == '1'
+SNAPSHOT_FORMAT = os.environ.get('MEDILINK_SNAPSHOT_FORMAT', 'json')
+RECORDS_STORAGE = os.environ.get('MEDILINK_RECORDS_STORAGE', 'json')
+DATABASE_PATH = os.environ.get('MEDILINK_DATABASE', os.path.join(DATA_DIR, 'medilink.db'))
+CHAT_RESPONDER = os.environ.get('MEDILINK_CHAT_RESPONDER', 'keyword')
+PASSWORD_HASH = os.environ.get('MEDILINK_PASSWORD_HASH', 'scrypt')
+PASSWORD_COST = os.environ.get('MEDILINK_PASSWORD_COST')
+SECRET_KEY = os.environ.get('MEDILINK_SECRET_KEY')
+TOKEN_TTL = int(os.environ.get('MEDILINK_TOKEN_TTL', str(24 * 60 * 60)))
+REQUIRE_TOKEN = os.environ.get('MEDILINK_REQUIRE_TOKEN', '0') == '1'
+WRITE_BEHIND_INTERVAL = float(os.environ.get('MEDILINK_WRITE_BEHIND_INTERVAL', '5'))
+CACHE_BACKEND = os.environ.get('MEDILINK_CACHE', 'memory')
+CACHE_SIZE = int(os.environ.get('MEDILINK_CACHE_SIZE', '4096'))
+CACHE_URL = os.environ.get('MEDILINK_CACHE_URL')
+
+if STORAGE == 'sqlite':
+    from sql_store import SqlStore
+
+    new_database = not os.path.exists(DATABASE_PATH)
+    store = SqlStore(DATABASE_PATH)
+    if new_database:
+        store.import_json(DATA_DIR)
+else:
+    store = Store(DATA_DIR, journal=PERSISTENCE == 'journal', fsync=JOURNAL_FSYNC,
+                  snapshot_format=SNAPSHOT_FORMAT, records_storage=RECORDS_STORAGE)
+atexit.register(store.close)
+
+# Registered after store.close, so it runs first and flushes into open files
+deferred_users = WriteBehind(store.users, interval=WRITE_BEHIND_INTERVAL)
+atexit.register(deferred_users.close)
+
+responder = assistant.RESPONDERS[CHAT_RESPONDER]()
+# Chat sessions live in this process only. With several workers a request
+# routed to another worker doesn't find its session_id and starts a new
+# session, so multi-worker deployments need sticky sessions for the chat.
+conversations = assistant.ConversationStore()
+tokens = TokenSigner(SECRET_KEY or load_key(os.path.join(DATA_DIR, 'secret.key')), ttl=TOKEN_TTL)
+passwords = PasswordHasher(PASSWORD_HASH, int(PASSWORD_COST) if PASSWORD_COST else None)
+cache = create_cache(CACHE_BACKEND, size=CACHE_SIZE, url=CACHE_URL)
+
+if STORAGE == 'sqlite':
+    # The dev server runs each request on a new thread; return its database
+    # connection to the pool instead of leaving one open per thread
+    @app.teardown_appcontext
+    def release_connection(error):
+        store.release()
+
+@app.cli.command('compact-data')
+def compact_data():
+    """Fold the collection journals into the JSON snapshots."""
+    store.compact()
+
+@app.cli.command('convert-data')
+@click.option('--to', 'snapshot_format', type=click.Choice(['json', 'binary']), required=True)
+def convert_data(snapshot_format):
+    """Fold the collections into JSON or binary snapshots."""
+    if STORAGE == 'sqlite':
+        print("Snapshot formats only apply to the JSON storage backend")
+        return
+    store.convert(snapshot_format)
+    if snapshot_format != SNAPSHOT_FORMAT:
+        # The server compacts into MEDILINK_SNAPSHOT_FORMAT, not what is on disk
+        print(f"Start the server with MEDILINK_SNAPSHOT_FORMAT={snapshot_format} to keep this format")
+
+@app.cli.command('import-json')
+def import_json():
+    """Copy the file-backed collections into the SQLite database."""
+    if STORAGE != 'sqlite':
+        print("Set MEDILINK_STORAGE=sqlite to import into the database")
+        return
+    for table, count in store.import_json(DATA_DIR).items():
+        print(f"  {table}: {count} rows")
 
 # Predefined doctors list
 DOCTORS = [
@@ -63,6 +133,250 @@ DOCTORS = [
     {"id": 8, "name": "Dr. David Brown", "specialization": "Endocrinology", "experience": "13 years", "rating": 4.5}
 ]
 
+# Symptom keywords in priority order: for each symptom, the first keyword of
+# this list that appears in it decides the specialization.
+SYMPTOM_SPECIALIZATIONS = [
+    ('chest pain', 'Cardiology'),
+    ('heart', 'Cardiology'),
+    ('blood pressure', 'Cardiology'),
+    ('skin rash', 'Dermatology'),
+    ('acne', 'Dermatology'),
+    ('eczema', 'Dermatology'),
+    ('fever', 'Pediatrics'),
+    ('child', 'Pediatrics'),
+    ('pediatric', 'Pediatrics'),
+    ('joint pain', 'Orthopedics'),
+    ('bone', 'Orthopedics'),
+    ('fracture', 'Orthopedics'),
+    ('menstrual', 'Gynecology'),
+    ('period', 'Gynecology'),
+    ('pregnancy', 'Gynecology'),
+    ('headache', 'Neurology'),
+    ('migraine', 'Neurology'),
+    ('seizure', 'Neurology'),
+    ('anxiety', 'Psychiatry'),
+    ('depression', 'Psychiatry'),
+    ('mental health', 'Psychiatry'),
+    ('weight', 'Endocrinology'),
+    ('diabetes', 'Endocrinology'),
+    ('thyroid', 'Endocrinology'),
+    ('hormone', 'Endocrinology')
+]
+
+SYMPTOM_MATCHER = assistant.KeywordMatcher(SYMPTOM_SPECIALIZATIONS)
+
+DOCTORS_BY_SPECIALIZATION = {}
+for doctor in DOCTORS:
+    DOCTORS_BY_SPECIALIZATION.setdefault(doctor['specialization'].lower(), []).append(doctor)
+
+# Recommendations are ranked by a weighted score of how well a doctor's
+# specialization matches the request, their rating, and how many of their
+# clinic slots are still free over the next AVAILABILITY_DAYS days, so
+# patients are steered towards doctors who can actually see them soon.
+CLINIC_SLOTS = ['09:00', '10:00', '11:00', '12:00', '13:00', '14:00', '15:00', '16:00']
+AVAILABILITY_DAYS = 7
+MATCH_WEIGHT = 0.6
+RATING_WEIGHT = 0.2
+AVAILABILITY_WEIGHT = 0.2
+
+def doctor_availability():
+    # Free slots per doctor id; computed once per request, also for batches
+    today = date.today()
+    end = today + timedelta(days=AVAILABILITY_DAYS - 1)
+    booked = store.doctor_bookings(today.isoformat(), end.isoformat())
+    capacity = len(CLINIC_SLOTS) * AVAILABILITY_DAYS
+    return {doctor['id']: max(capacity - booked.get(doctor['id'], 0), 0) for doctor in DOCTORS}
+
+def match_strengths(symptoms, specialization):
+    # Share of the request pointing at each specialization
+    if specialization:
+        return {specialization.lower(): 1.0}
+    
+    strengths = {}
+    symptoms = symptoms or []
+    for symptom in symptoms:
+        spec = SYMPTOM_MATCHER.match(symptom)
+        if spec is not None:
+            strengths[spec.lower()] = strengths.get(spec.lower(), 0) + 1 / len(symptoms)
+    return strengths
+
+def query_error(query):
+    # What is wrong with a recommendation query, or None if it is valid
+    symptoms = query.get('symptoms')
+    if symptoms is not None and (not isinstance(symptoms, list) or
+                                 not all(isinstance(symptom, str) for symptom in symptoms)):
+        return "symptoms must be a list of strings"
+    specialization = query.get('specialization')
+    if specialization is not None and not isinstance(specialization, str):
+        return "specialization must be a string"
+    return None
+
+def recommend(symptoms, specialization, availability, limit=3):
+    strengths = match_strengths(symptoms, specialization)
+    candidates = [doctor for spec in strengths for doctor in DOCTORS_BY_SPECIALIZATION.get(spec, [])]
+    if not candidates:
+        # Nothing matched: rank every doctor on rating and availability alone
+        candidates = DOCTORS
+    
+    capacity = len(CLINIC_SLOTS) * AVAILABILITY_DAYS
+    def score(doctor):
+        return (MATCH_WEIGHT * strengths.get(doctor['specialization'].lower(), 0) +
+                RATING_WEIGHT * doctor['rating'] / 5 +
+                AVAILABILITY_WEIGHT * availability[doctor['id']] / capacity)
+    
+    # nlargest keeps the doctors' original order among equal scores
+    ranked = heapq.nlargest(limit, candidates, key=score)
+    return [dict(doctor, score=round(score(doctor), 3), free_slots=availability[doctor['id']])
+            for doctor in ranked]
+
+SLOT_TAKEN_ERROR = "This time slot is already booked. Please choose another time."
+
+MAX_PAGE_SIZE = 500
+MAX_BATCH_SIZE = 500
+STREAM_BATCH_SIZE = 500
+
+# Shared by the list and export endpoints. Optional query parameters, all
+# applied by the storage layer rather than after loading every row:
+#   user_id  - only rows belonging to this user
+#   from/to  - inclusive YYYY-MM-DD range on the collection's date field
+#   limit    - page size (at most MAX_PAGE_SIZE); when more rows follow,
+#              the X-Next-Cursor header holds the value to pass as cursor
+#   cursor   - continue after the previous page
+#   fields   - comma separated list of fields to return
+def parse_list_query(owner_field, date_field):
+    args = request.args
+    query = {"date_field": date_field, "start": args.get('from'), "end": args.get('to')}
+    
+    if args.get('user_id'):
+        try:
+            query['field'], query['value'] = owner_field, int(args['user_id'])
+        except ValueError:
+            return None, (jsonify({"error": "Invalid user ID"}), 400)
+    
+    try:
+        query['limit'] = int(args['limit']) if args.get('limit') else None
+        query['after'] = int(args['cursor']) if args.get('cursor') else None
+    except ValueError:
+        return None, (jsonify({"error": "Invalid limit or cursor"}), 400)
+    
+    if query['limit'] is not None and not 1 <= query['limit'] <= MAX_PAGE_SIZE:
+        return None, (jsonify({"error": f"limit must be between 1 and {MAX_PAGE_SIZE}"}), 400)
+    
+    query['fields'] = [field for field in args.get('fields', '').split(',') if field] or None
+    return query, None
+
+# Stream every matching row as a JSON array (or NDJSON), reading the
+# collection one batch at a time so memory use doesn't grow with its size
+# and the first rows go out before the last ones are read.
+def stream_rows(collection, query, ndjson=False):
+    query = dict(query, limit=STREAM_BATCH_SIZE)
+    
+    def generate():
+        separator = ''
+        if not ndjson:
+            yield '['
+        while True:
+            rows, query['after'] = collection.page(**query)
+            if rows:
+                encoded = [app.json.dumps(row, separators=(',', ':')) for row in rows]
+                if ndjson:
+                    yield '\n'.join(encoded) + '\n'
+                else:
+                    yield separator + ','.join(encoded)
+                    separator = ','
+            if query['after'] is None:
+                break
+        if not ndjson:
+            yield ']\n'
+    
+    # Keep the context until the last row, so teardown runs after streaming
+    return Response(stream_with_context(generate()),
+                    mimetype='application/x-ndjson' if ndjson else 'application/json')
+
+def wants_ndjson():
+    return request.args.get('format') == 'ndjson' or \
+        request.accept_mimetypes.best == 'application/x-ndjson'
+
+def list_rows(collection, owner_field, date_field):
+    query, error = parse_list_query(owner_field, date_field)
+    if error:
+        return error
+    error = authorize(query.get('value'))
+    if error:
+        return error
+    
+    # Whole-collection listings are streamed instead of built in memory
+    if 'field' not in query and query['limit'] is None:
+        return stream_rows(collection, query, ndjson=wants_ndjson())
+    
+    # A user's listing is tagged with the version of their rows, so
+    # re-reading unchanged data gets a 304 without loading or encoding rows
+    etag = None
+    if 'field' in query:
+        version = collection.version(owner_field, query['value'])
+        etag = hashlib.sha1(f'{version} {request.full_path}'.encode()).hexdigest()
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
+    
+    # The plain ?user_id= listing the dashboards fetch is served from the
+    # response cache
+    if etag is not None and set(request.args) == {'user_id'}:
+        body = cached_body(request.endpoint, query['value'], version,
+                           lambda: jsonify(collection.page(**query)[0]).get_data())
+        response = Response(body, mimetype='application/json')
+    else:
+        rows, next_cursor = collection.page(**query)
+        response = jsonify(rows)
+        if next_cursor is not None:
+            response.headers['X-Next-Cursor'] = str(next_cursor)
+    if etag is not None:
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+# Read-through cache of serialized responses, keyed by (endpoint, user_id).
+# Handlers that change a user's data invalidate that user's entries. Each
+# entry also records the version it was built from, and one that no longer
+# matches is rebuilt, so a worker never serves what another one changed.
+def cache_key(endpoint, user_id):
+    return f'{endpoint}:{user_id}'
+
+def cached_body(endpoint, user_id, version, build):
+    key = cache_key(endpoint, user_id)
+    tag = version.encode() + b'\n'
+    entry = cache.get(key)
+    if entry is not None and entry.startswith(tag):
+        return entry[len(tag):]
+    
+    body = build()
+    cache.set(key, tag + body)
+    return body
+
+def invalidate(endpoint, user_id):
+    cache.delete(cache_key(endpoint, user_id), cache_key('get_user_stats', user_id))
+
+# Owner ids in request bodies must be ints like the ids the store assigns
+def valid_id(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+# Checks the request may act for `user_id` (None for data not owned by one
+# user). Only the token's signature is verified, so this needs no lookup.
+def authorize(user_id):
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    if scheme.lower() != 'bearer' or not token:
+        if REQUIRE_TOKEN:
+            return jsonify({"error": "Authentication required"}), 401
+        return None
+    
+    token_user = tokens.verify(token)
+    if token_user is None:
+        return jsonify({"error": "Invalid or expired token"}), 401
+    if user_id is None or str(token_user) != str(user_id):
+        return jsonify({"error": "Not allowed to access this user's data"}), 403
+    return None
+
 # Routes
 @app.route('/')
 def home():
@@ -78,19 +392,18 @@ def register():
     for field in required_fields:
         if not data.get(field):
             return jsonify({"error": f"Missing required field: {field}"}), 400
-    
-    users = read_json(USERS_FILE)
+    if not isinstance(data['email'], str) or not isinstance(data['password'], str):
+        return jsonify({"error": "Email and password must be strings"}), 400
     
     # Check if user already exists
-    if any(user['email'] == data['email'] for user in users):
+    if store.users.find_one('email', data['email']):
         return jsonify({"error": "User with this email already exists"}), 400
     
     # Create new user
     new_user = {
-        "id": len(users) + 1,
         "name": data['name'],
         "email": data['email'],
-        "password": data['password'],  # In a real app, hash the password
+        "password": passwords.hash(data['password']),
         "dob": data['dob'],
         "gender": data['gender'],
         "phone": data['phone'],
@@ -99,8 +412,10 @@ def register():
         "updated_at": datetime.now().isoformat()
     }
     
-    users.append(new_user)
-    write_json(USERS_FILE, users)
+    try:
+        new_user = store.users.insert(new_user)
+    except DuplicateKeyError:
+        return jsonify({"error": "User with this email already exists"}), 400
     
     return jsonify({
         "message": "User registered successfully", 
@@ -123,19 +438,24 @@ def login():
     # Validate required fields
     if not data.get('email') or not data.get('password'):
         return jsonify({"error": "Email and password are required"}), 400
+    if not isinstance(data['email'], str) or not isinstance(data['password'], str):
+        return jsonify({"error": "Email and password must be strings"}), 400
     
-    users = read_json(USERS_FILE)
-    
-    user = next((u for u in users if u['email'] == data['email'] and u['password'] == data['password']), None)
+    # Hashing runs outside the store's locks so logins verify in parallel
+    user = store.users.find_one('email', data['email'])
+    if not passwords.verify(data['password'], user['password'] if user else None):
+        user = None
     
     if user:
-        # Update last login
-        user['last_login'] = datetime.now().isoformat()
-        write_json(USERS_FILE, users)
+        # last_login goes through the write-behind queue; upgrading a
+        # plaintext or outdated hash is written straight away
+        deferred_users.defer(user['id'], {"last_login": datetime.now().isoformat()})
+        if passwords.needs_rehash(user['password']):
+            store.users.update(user['id'], {"password": passwords.hash(data['password'])})
         
-        # In a real app, you would generate a JWT token here
         return jsonify({
             "message": "Login successful",
+            "token": tokens.issue(user['id']),
             "user": {
                 "id": user['id'],
                 "name": user['name'],
@@ -157,22 +477,28 @@ def update_profile():
     
     if not data.get('user_id'):
         return jsonify({"error": "User ID is required"}), 400
+    if not valid_id(data['user_id']):
+        return jsonify({"error": "Invalid user ID"}), 400
+    error = authorize(data['user_id'])
+    if error:
+        return error
     
-    users = read_json(USERS_FILE)
-    user = next((u for u in users if u['id'] == data['user_id']), None)
+    user = store.users.get(data['user_id'])
     
     if not user:
         return jsonify({"error": "User not found"}), 404
     
     # Update user data
     update_fields = ['name', 'email', 'phone', 'dob', 'gender', 'address']
-    for field in update_fields:
-        if field in data:
-            user[field] = data[field]
-    
-    user['updated_at'] = datetime.now().isoformat()
+    changes = {field: data[field] for field in update_fields if field in data}
+    if 'email' in changes and not isinstance(changes['email'], str):
+        return jsonify({"error": "Email must be a string"}), 400
+    changes['updated_at'] = datetime.now().isoformat()
     
-    write_json(USERS_FILE, users)
+    try:
+        user = store.users.update(user['id'], changes)
+    except DuplicateKeyError:
+        return jsonify({"error": "User with this email already exists"}), 400
     
     return jsonify({
         "message": "Profile updated successfully",
@@ -194,6 +520,11 @@ def save_medical_info():
     
     if not data.get('user_id'):
         return jsonify({"error": "User ID is required"}), 400
+    if not valid_id(data['user_id']):
+        return jsonify({"error": "Invalid user ID"}), 400
+    error = authorize(data['user_id'])
+    if error:
+        return error
     
     # In a real app, you would save this to a proper database
     # For now, we'll just return success
@@ -208,39 +539,34 @@ def change_password():
     
     if not data.get('user_id') or not data.get('current_password') or not data.get('new_password'):
         return jsonify({"error": "User ID, current password and new password are required"}), 400
+    if not valid_id(data['user_id']):
+        return jsonify({"error": "Invalid user ID"}), 400
+    if not isinstance(data['current_password'], str) or not isinstance(data['new_password'], str):
+        return jsonify({"error": "Passwords must be strings"}), 400
+    error = authorize(data['user_id'])
+    if error:
+        return error
     
-    users = read_json(USERS_FILE)
-    user = next((u for u in users if u['id'] == data['user_id']), None)
+    user = store.users.get(data['user_id'])
     
     if not user:
         return jsonify({"error": "User not found"}), 404
     
-    if user['password'] != data['current_password']:
+    if not passwords.verify(data['current_password'], user['password']):
         return jsonify({"error": "Current password is incorrect"}), 400
     
     # Update password
-    user['password'] = data['new_password']
-    user['updated_at'] = datetime.now().isoformat()
-    
-    write_json(USERS_FILE, users)
+    store.users.update(user['id'], {
+        "password": passwords.hash(data['new_password']),
+        "updated_at": datetime.now().isoformat()
+    })
     
     return jsonify({"message": "Password changed successfully"})
 
 # Appointments routes
 @app.route('/api/appointments', methods=['GET'])
 def get_appointments():
-    user_id = request.args.get('user_id')
-    
-    appointments = read_json(APPOINTMENTS_FILE)
-    
-    if user_id:
-        try:
-            user_appointments = [apt for apt in appointments if apt['patient_id'] == int(user_id)]
-            return jsonify(user_appointments)
-        except ValueError:
-            return jsonify({"error": "Invalid user ID"}), 400
-    
-    return jsonify(appointments)
+    return list_rows(store.appointments, 'patient_id', 'date')
 
 @app.route('/api/appointments', methods=['POST'])
 def create_appointment():
@@ -251,8 +577,13 @@ def create_appointment():
     for field in required_fields:
         if not data.get(field):
             return jsonify({"error": f"Missing required field: {field}"}), 400
-    
-    appointments = read_json(APPOINTMENTS_FILE)
+    if not valid_id(data['patient_id']):
+        return jsonify({"error": "Invalid patient ID"}), 400
+    if not isinstance(data['date'], str) or not isinstance(data['time'], str):
+        return jsonify({"error": "Invalid date or time"}), 400
+    error = authorize(data['patient_id'])
+    if error:
+        return error
     
     # Find doctor details
     doctor = next((d for d in DOCTORS if d['id'] == data['doctor_id']), None)
@@ -260,16 +591,11 @@ def create_appointment():
         return jsonify({"error": "Doctor not found"}), 404
     
     # Check if appointment time is available
-    existing_appointment = next((apt for apt in appointments 
-                               if apt['doctor_id'] == data['doctor_id'] 
-                               and apt['date'] == data['date'] 
-                               and apt['time'] == data['time']), None)
-    
-    if existing_appointment:
-        return jsonify({"error": "This time slot is already booked. Please choose another time."}), 400
+    slot = (data['doctor_id'], data['date'], data['time'])
+    if store.appointments.find_one('slot', slot):
+        return jsonify({"error": SLOT_TAKEN_ERROR}), 400
     
     new_appointment = {
-        "id": len(appointments) + 1,
         "patient_id": data['patient_id'],
         "doctor_id": data['doctor_id'],
         "doctor_name": doctor['name'],
@@ -281,8 +607,11 @@ def create_appointment():
         "created_at": datetime.now().isoformat()
     }
     
-    appointments.append(new_appointment)
-    write_json(APPOINTMENTS_FILE, appointments)
+    try:
+        new_appointment = store.appointments.insert(new_appointment)
+    except DuplicateKeyError:
+        return jsonify({"error": SLOT_TAKEN_ERROR}), 400
+    invalidate('get_appointments', new_appointment['patient_id'])
     
     return jsonify({
         "message": "Appointment created successfully", 
@@ -293,19 +622,26 @@ def create_appointment():
 def update_appointment(appointment_id):
     data = request.json
     
-    appointments = read_json(APPOINTMENTS_FILE)
-    
-    appointment = next((apt for apt in appointments if apt['id'] == appointment_id), None)
+    appointment = store.appointments.get(appointment_id)
     if not appointment:
         return jsonify({"error": "Appointment not found"}), 404
+    error = authorize(appointment['patient_id'])
+    if error:
+        return error
     
     # Update appointment
     allowed_fields = ['date', 'time', 'reason', 'status']
-    for field in allowed_fields:
-        if field in data:
-            appointment[field] = data[field]
+    changes = {field: data[field] for field in allowed_fields if field in data}
+    if any(not isinstance(changes[field], str) for field in ('date', 'time') if field in changes):
+        return jsonify({"error": "Invalid date or time"}), 400
     
-    write_json(APPOINTMENTS_FILE, appointments)
+    # Rescheduling must not land on a slot that is already booked
+    try:
+        appointment = store.appointments.update(appointment_id, changes)
+    except DuplicateKeyError:
+        return jsonify({"error": SLOT_TAKEN_ERROR}), 400
+    if appointment:
+        invalidate('get_appointments', appointment['patient_id'])
     
     return jsonify({
         "message": "Appointment updated successfully", 
@@ -314,32 +650,22 @@ def update_appointment(appointment_id):
 
 @app.route('/api/appointments/<int:appointment_id>', methods=['DELETE'])
 def delete_appointment(appointment_id):
-    appointments = read_json(APPOINTMENTS_FILE)
+    appointment = store.appointments.get(appointment_id)
+    error = authorize(appointment['patient_id']) if appointment else None
+    if error:
+        return error
     
-    appointment = next((apt for apt in appointments if apt['id'] == appointment_id), None)
+    appointment = store.appointments.delete(appointment_id)
     if not appointment:
         return jsonify({"error": "Appointment not found"}), 404
-    
-    appointments.remove(appointment)
-    write_json(APPOINTMENTS_FILE, appointments)
+    invalidate('get_appointments', appointment['patient_id'])
     
     return jsonify({"message": "Appointment deleted successfully"})
 
 # Medical records routes
 @app.route('/api/medical-records', methods=['GET'])
 def get_medical_records():
-    user_id = request.args.get('user_id')
-    
-    records = read_json(MEDICAL_RECORDS_FILE)
-    
-    if user_id:
-        try:
-            user_records = [record for record in records if record['patient_id'] == int(user_id)]
-            return jsonify(user_records)
-        except ValueError:
-            return jsonify({"error": "Invalid user ID"}), 400
-    
-    return jsonify(records)
+    return list_rows(store.medical_records, 'patient_id', 'date')
 
 @app.route('/api/medical-records', methods=['POST'])
 def create_medical_record():
@@ -350,11 +676,13 @@ def create_medical_record():
     for field in required_fields:
         if not data.get(field):
             return jsonify({"error": f"Missing required field: {field}"}), 400
-    
-    records = read_json(MEDICAL_RECORDS_FILE)
+    if not valid_id(data['patient_id']):
+        return jsonify({"error": "Invalid patient ID"}), 400
+    error = authorize(data['patient_id'])
+    if error:
+        return error
     
     new_record = {
-        "id": len(records) + 1,
         "patient_id": data['patient_id'],
         "record_type": data['record_type'],
         "description": data['description'],
@@ -363,8 +691,8 @@ def create_medical_record():
         "created_at": datetime.now().isoformat()
     }
     
-    records.append(new_record)
-    write_json(MEDICAL_RECORDS_FILE, records)
+    new_record = store.medical_records.insert(new_record)
+    invalidate('get_medical_records', new_record['patient_id'])
     
     return jsonify({
         "message": "Medical record created successfully", 
@@ -375,19 +703,20 @@ def create_medical_record():
 def update_medical_record(record_id):
     data = request.json
     
-    records = read_json(MEDICAL_RECORDS_FILE)
-    
-    record = next((rec for rec in records if rec['id'] == record_id), None)
+    record = store.medical_records.get(record_id)
     if not record:
         return jsonify({"error": "Medical record not found"}), 404
+    error = authorize(record['patient_id'])
+    if error:
+        return error
     
     # Update record
     allowed_fields = ['record_type', 'description', 'date', 'doctor']
-    for field in allowed_fields:
-        if field in data:
-            record[field] = data[field]
+    changes = {field: data[field] for field in allowed_fields if field in data}
     
-    write_json(MEDICAL_RECORDS_FILE, records)
+    record = store.medical_records.update(record_id, changes)
+    if record:
+        invalidate('get_medical_records', record['patient_id'])
     
     return jsonify({
         "message": "Medical record updated successfully", 
@@ -396,32 +725,22 @@ def update_medical_record(record_id):
 
 @app.route('/api/medical-records/<int:record_id>', methods=['DELETE'])
 def delete_medical_record(record_id):
-    records = read_json(MEDICAL_RECORDS_FILE)
+    record = store.medical_records.get(record_id)
+    error = authorize(record['patient_id']) if record else None
+    if error:
+        return error
     
-    record = next((rec for rec in records if rec['id'] == record_id), None)
+    record = store.medical_records.delete(record_id)
     if not record:
         return jsonify({"error": "Medical record not found"}), 404
-    
-    records.remove(record)
-    write_json(MEDICAL_RECORDS_FILE, records)
+    invalidate('get_medical_records', record['patient_id'])
     
     return jsonify({"message": "Medical record deleted successfully"})
 
 # Period tracker routes
 @app.route('/api/period-tracker', methods=['GET'])
 def get_period_data():
-    user_id = request.args.get('user_id')
-    
-    period_data = read_json(PERIOD_TRACKER_FILE)
-    
-    if user_id:
-        try:
-            user_data = [data for data in period_data if data['user_id'] == int(user_id)]
-            return jsonify(user_data)
-        except ValueError:
-            return jsonify({"error": "Invalid user ID"}), 400
-    
-    return jsonify(period_data)
+    return list_rows(store.period_tracker, 'user_id', 'start_date')
 
 @app.route('/api/period-tracker', methods=['POST'])
 def add_period_data():
@@ -432,11 +751,13 @@ def add_period_data():
     for field in required_fields:
         if not data.get(field):
             return jsonify({"error": f"Missing required field: {field}"}), 400
-    
-    period_data = read_json(PERIOD_TRACKER_FILE)
+    if not valid_id(data['user_id']):
+        return jsonify({"error": "Invalid user ID"}), 400
+    error = authorize(data['user_id'])
+    if error:
+        return error
     
     new_entry = {
-        "id": len(period_data) + 1,
         "user_id": data['user_id'],
         "start_date": data['start_date'],
         "end_date": data['end_date'],
@@ -445,8 +766,8 @@ def add_period_data():
         "created_at": datetime.now().isoformat()
     }
     
-    period_data.append(new_entry)
-    write_json(PERIOD_TRACKER_FILE, period_data)
+    new_entry = store.period_tracker.insert(new_entry)
+    invalidate('get_period_data', new_entry['user_id'])
     
     return jsonify({
         "message": "Period data added successfully", 
@@ -455,14 +776,15 @@ def add_period_data():
 
 @app.route('/api/period-tracker/<int:entry_id>', methods=['DELETE'])
 def delete_period_entry(entry_id):
-    period_data = read_json(PERIOD_TRACKER_FILE)
+    entry = store.period_tracker.get(entry_id)
+    error = authorize(entry['user_id']) if entry else None
+    if error:
+        return error
     
-    entry = next((data for data in period_data if data['id'] == entry_id), None)
+    entry = store.period_tracker.delete(entry_id)
     if not entry:
         return jsonify({"error": "Period entry not found"}), 404
-    
-    period_data.remove(entry)
-    write_json(PERIOD_TRACKER_FILE, period_data)
+    invalidate('get_period_data', entry['user_id'])
     
     return jsonify({"message": "Period entry deleted successfully"})
 
@@ -471,157 +793,175 @@ def delete_period_entry(entry_id):
 def recommend_doctors():
     data = request.json
     
+    error = query_error(data)
+    if error:
+        return jsonify({"error": error}), 400
+    
     symptoms = data.get('symptoms', [])
     specialization = data.get('specialization', '')
     
-    # Simple AI logic to recommend doctors
-    recommended_doctors = []
+    return jsonify(recommend(symptoms, specialization, doctor_availability()))
+
+@app.route('/api/ai/recommend-doctors/batch', methods=['POST'])
+def recommend_doctors_batch():
+    data = request.json
     
-    if specialization:
-        # Filter by requested specialization
-        recommended_doctors = [doc for doc in DOCTORS if doc['specialization'].lower() == specialization.lower()]
-    elif symptoms:
-        # Simple symptom-based recommendation
-        symptom_specialization_map = {
-            'chest pain': 'Cardiology',
-            'heart': 'Cardiology',
-            'blood pressure': 'Cardiology',
-            'skin rash': 'Dermatology',
-            'acne': 'Dermatology',
-            'eczema': 'Dermatology',
-            'fever': 'Pediatrics',
-            'child': 'Pediatrics',
-            'pediatric': 'Pediatrics',
-            'joint pain': 'Orthopedics',
-            'bone': 'Orthopedics',
-            'fracture': 'Orthopedics',
-            'menstrual': 'Gynecology',
-            'period': 'Gynecology',
-            'pregnancy': 'Gynecology',
-            'headache': 'Neurology',
-            'migraine': 'Neurology',
-            'seizure': 'Neurology',
-            'anxiety': 'Psychiatry',
-            'depression': 'Psychiatry',
-            'mental health': 'Psychiatry',
-            'weight': 'Endocrinology',
-            'diabetes': 'Endocrinology',
-            'thyroid': 'Endocrinology',
-            'hormone': 'Endocrinology'
-        }
-        
-        for symptom in symptoms:
-            symptom_lower = symptom.lower()
-            for key, spec in symptom_specialization_map.items():
-                if key in symptom_lower:
-                    recommended_doctors.extend([doc for doc in DOCTORS if doc['specialization'] == spec])
-                    break
-    
-    # Remove duplicates and limit to top 3
-    if not recommended_doctors:
-        recommended_doctors = DOCTORS[:3]  # Default to first 3 doctors
-    
-    # Remove duplicates by doctor id
-    seen = set()
-    unique_doctors = []
-    for doc in recommended_doctors:
-        if doc['id'] not in seen:
-            seen.add(doc['id'])
-            unique_doctors.append(doc)
-    
-    return jsonify(unique_doctors[:3])  # Return top 3 recommendations
+    queries = data.get('queries')
+    if not isinstance(queries, list) or not all(isinstance(query, dict) for query in queries):
+        return jsonify({"error": "queries must be a list of objects"}), 400
+    if len(queries) > MAX_BATCH_SIZE:
+        return jsonify({"error": f"At most {MAX_BATCH_SIZE} queries per batch"}), 400
+    for i, query in enumerate(queries):
+        error = query_error(query)
+        if error:
+            return jsonify({"error": f"queries[{i}]: {error}"}), 400
+    
+    availability = doctor_availability()
+    results = [recommend(query.get('symptoms', []), query.get('specialization', ''), availability)
+               for query in queries]
+    
+    return jsonify({"results": results})
 
 # AI Chat
+# Chats keep their earlier turns server-side: clients send back the
+# session_id from the previous reply instead of the history. A question
+# already answered in the session is replied to from there.
+def chat_reply(session_id, message):
+    # Chunks of the reply; the turn is recorded once it is complete
+    cached = conversations.cached_reply(session_id, message)
+    if cached is not None:
+        chunks = [cached]
+    else:
+        chunks = responder.stream(message, conversations.history(session_id))
+    
+    reply = []
+    for chunk in chunks:
+        reply.append(chunk)
+        yield chunk
+    conversations.record(session_id, message, ''.join(reply))
+
 @app.route('/api/ai/chat', methods=['POST'])
 def ai_chat():
     data = request.json
     
-    user_message = data.get('message', '').lower()
-    
-    # Simple AI response logic
-    responses = {
-        'hello': 'Hello! How can I assist you with your health concerns today?',
-        'hi': 'Hi there! I\'m here to help with your medical questions.',
-        'appointment': 'You can schedule an appointment by going to the Appointments section and selecting a doctor.',
-        'book appointment': 'To book an appointment, visit the Appointments page and choose your preferred doctor and time slot.',
-        'symptoms': 'If you\'re experiencing symptoms, I can help recommend a specialist. Please describe your symptoms in detail.',
-        'pain': 'I\'m sorry to hear you\'re in pain. Can you describe the location and type of pain? For serious pain, please seek immediate medical attention.',
-        'fever': 'Fever can be a sign of infection. Please monitor your temperature and consult a doctor if it persists for more than 48 hours or is very high.',
-        'headache': 'Headaches can have various causes. If it\'s severe or persistent, I recommend consulting with Dr. James Wilson (Neurology).',
-        'records': 'You can view your medical records in the Medical Records section of your dashboard.',
-        'medical records': 'Your medical history is available in the Medical Records section. You can also add new records there.',
-        'prescription': 'For prescription refills, please contact your doctor directly or schedule an appointment.',
-        'medicine': 'Please consult with your doctor for medication-related questions. Never self-medicate without professional advice.',
-        'emergency': 'If this is a medical emergency, please call emergency services immediately or go to the nearest hospital.',
-        'help': 'I can help you with: booking appointments, finding doctors based on symptoms, accessing medical records, and answering general health questions.',
-        'thank': 'You\'re welcome! Is there anything else I can help you with?',
-        'bye': 'Goodbye! Take care of your health and don\'t hesitate to reach out if you need assistance.'
-    }
-    
-    # Find the best matching response
-    response = "I'm here to help with your health questions. You can ask me about appointments, symptoms, medical records, or general health concerns."
-    
-    for key in responses:
-        if key in user_message:
-            response = responses[key]
-            break
+    message = data.get('message', '')
+    session_id = conversations.open(data.get('session_id'))
+    response = ''.join(chat_reply(session_id, message))
     
-    # If no specific match found, provide general guidance
-    if response == "I'm here to help with your health questions. You can ask me about appointments, symptoms, medical records, or general health concerns.":
-        if any(word in user_message for word in ['doctor', 'specialist', 'expert']):
-            response = "I can help you find the right specialist based on your symptoms. Try using our AI doctor recommendation feature in the Appointments section."
-        elif any(word in user_message for word in ['period', 'menstrual', 'cycle']):
-            response = "For menstrual cycle tracking and related concerns, please use our Period Tracker feature or consult with Dr. Lisa Patel (Gynecology)."
-        elif any(word in user_message for word in ['test', 'lab', 'result']):
-            response = "You can view your lab test results in the Medical Records section. For new tests, please schedule an appointment with your doctor."
+    return jsonify({"response": response, "session_id": session_id})
+
+# Same reply as /api/ai/chat, sent as Server-Sent Events while the responder
+# produces it: a "data: {"delta": ...}" event per chunk, then a "done" event
+# with the full response and session id. GET with ?message=&session_id=
+# serves EventSource clients.
+@app.route('/api/ai/chat/stream', methods=['GET', 'POST'])
+def ai_chat_stream():
+    data = request.args if request.method == 'GET' else (request.json or {})
+    message = data.get('message', '')
+    session_id = conversations.open(data.get('session_id'))
     
-    return jsonify({"response": response})
+    def events():
+        chunks = []
+        try:
+            for chunk in chat_reply(session_id, message):
+                chunks.append(chunk)
+                yield f"data: {app.json.dumps({'delta': chunk})}\n\n"
+        except Exception:
+            app.logger.exception('Chat responder failed')
+            yield f"event: error\ndata: {app.json.dumps({'error': 'Internal server error'})}\n\n"
+            return
+        done = {'response': ''.join(chunks), 'session_id': session_id}
+        yield f"event: done\ndata: {app.json.dumps(done)}\n\n"
+    
+    return Response(events(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# Bulk export
+EXPORTS = {
+    'appointments': (store.appointments, 'patient_id', 'date'),
+    'medical-records': (store.medical_records, 'patient_id', 'date'),
+    'period-tracker': (store.period_tracker, 'user_id', 'start_date')
+}
+
+@app.route('/api/export/<name>', methods=['GET'])
+def export_collection(name):
+    if name not in EXPORTS:
+        return jsonify({"error": "Unknown collection"}), 404
+    
+    collection, owner_field, date_field = EXPORTS[name]
+    query, error = parse_list_query(owner_field, date_field)
+    if error:
+        return error
+    error = authorize(query.get('value'))
+    if error:
+        return error
+    
+    # NDJSON unless a JSON array is asked for explicitly
+    ndjson = request.args.get('format') != 'json'
+    response = stream_rows(collection, dict(query, limit=None), ndjson=ndjson)
+    extension = 'ndjson' if ndjson else 'json'
+    response.headers['Content-Disposition'] = f'attachment; filename={name.replace("-", "_")}.{extension}'
+    return response
 
 # Get all doctors
+# Static reference data is serialized once, with a strong ETag of the body,
+# so clients and proxies can revalidate and get a 304 instead of the body.
+def static_body(payload):
+    body = (app.json.dumps(payload, separators=(',', ':')) + '\n').encode()
+    return body, hashlib.sha1(body).hexdigest()
+
+def send_static(body, etag, cache_control):
+    response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = cache_control
+    return response.make_conditional(request)
+
+DOCTORS_BODY = static_body(DOCTORS)
+
 @app.route('/api/doctors', methods=['GET'])
 def get_doctors():
-    return jsonify(DOCTORS)
+    return send_static(*DOCTORS_BODY, 'public, max-age=300')
 
 # Get user statistics
 @app.route('/api/user-stats/<int:user_id>', methods=['GET'])
 def get_user_stats(user_id):
-    appointments = read_json(APPOINTMENTS_FILE)
-    medical_records = read_json(MEDICAL_RECORDS_FILE)
-    period_data = read_json(PERIOD_TRACKER_FILE)
-    
-    user_appointments = [apt for apt in appointments if apt['patient_id'] == user_id]
-    user_records = [record for record in medical_records if record['patient_id'] == user_id]
-    user_period_data = [data for data in period_data if data['user_id'] == user_id]
-    
-    stats = {
-        "total_appointments": len(user_appointments),
-        "upcoming_appointments": len([apt for apt in user_appointments if apt['status'] == 'Scheduled' and datetime.strptime(apt['date'], '%Y-%m-%d') >= datetime.now()]),
-        "total_records": len(user_records),
-        "total_cycles": len(user_period_data)
-    }
+    error = authorize(user_id)
+    if error:
+        return error
+    
+    # Counters are maintained by the store as data changes
+    today = date.today().isoformat()
+    version = ' '.join([today, store.appointments.version('patient_id', user_id),
+                        store.medical_records.version('patient_id', user_id),
+                        store.period_tracker.version('user_id', user_id)])
+    body = cached_body('get_user_stats', user_id, version,
+                       lambda: jsonify(store.user_stats(user_id, today)).get_data())
     
-    return jsonify(stats)
+    return Response(body, mimetype='application/json')
 
 # Health tips
+HEALTH_TIPS = [
+    "Stay hydrated by drinking at least 8 glasses of water daily.",
+    "Aim for 7-9 hours of quality sleep each night.",
+    "Include at least 30 minutes of physical activity in your daily routine.",
+    "Eat a balanced diet rich in fruits, vegetables, and whole grains.",
+    "Practice stress-reduction techniques like meditation or deep breathing.",
+    "Don't skip regular health check-ups and preventive screenings.",
+    "Wash your hands frequently to prevent the spread of germs.",
+    "Limit processed foods and added sugars in your diet.",
+    "Wear sunscreen daily to protect your skin from UV damage.",
+    "Take regular breaks from screens to protect your eye health."
+]
+
+# Three random tips per day, so the response can be revalidated all day
+@functools.lru_cache(maxsize=2)
+def health_tips_body(day):
+    selected_tips = random.Random(day).sample(HEALTH_TIPS, 3)
+    return static_body({"tips": selected_tips})
+
 @app.route('/api/health-tips', methods=['GET'])
 def get_health_tips():
-    tips = [
-        "Stay hydrated by drinking at least 8 glasses of water daily.",
-        "Aim for 7-9 hours of quality sleep each night.",
-        "Include at least 30 minutes of physical activity in your daily routine.",
-        "Eat a balanced diet rich in fruits, vegetables, and whole grains.",
-        "Practice stress-reduction techniques like meditation or deep breathing.",
-        "Don't skip regular health check-ups and preventive screenings.",
-        "Wash your hands frequently to prevent the spread of germs.",
-        "Limit processed foods and added sugars in your diet.",
-        "Wear sunscreen daily to protect your skin from UV damage.",
-        "Take regular breaks from screens to protect your eye health."
-    ]
-    
-    import random
-    selected_tips = random.sample(tips, 3)
-    
-    return jsonify({"tips": selected_tips})
+    return send_static(*health_tips_body(date.today().toordinal()), 'public, no-cache')
 
 # Error handlers
 @app.errorhandler(404)
@@ -650,7 +990,10 @@ if __name__ == '__main__':
     print("  GET  /api/period-tracker?user_id=<id> - Get period data")
     print("  POST /api/period-tracker - Add period data")
     print("  POST /api/ai/recommend-doctors - Get doctor recommendations")
+    print("  POST /api/ai/recommend-doctors/batch - Recommendations for many queries")
     print("  POST /api/ai/chat - AI health assistant")
+    print("  POST /api/ai/chat/stream - AI health assistant, streamed as server-sent events")
+    print("  GET  /api/export/<collection> - Stream a full collection export")
     print("\nServer running on http://localhost:5000")
     
     app.run(debug=True, port=5000)
\ No newline at end of file
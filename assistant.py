@@ -0,0 +1,161 @@
+import re
+import secrets
+import threading
+import time
+from collections import OrderedDict, deque
+
+
+# Health assistant behind /api/ai/chat.
+#
+# Replies come from a Responder, which yields the reply as a sequence of
+# text chunks so the streaming endpoint can send each one as soon as it is
+# ready; the plain endpoint joins them. The built-in KeywordResponder scans
+# the message once with a KeywordMatcher compiled at import time, and the
+# highest-priority keyword found anywhere in it decides the intent. Other
+# responders (e.g. a local model yielding tokens) register in RESPONDERS.
+#
+# Each chat belongs to a session kept in a ConversationStore, so responders
+# see the previous turns without the client resending them. Memory is
+# bounded: least recently used sessions are evicted beyond MAX_SESSIONS,
+# each keeps its last MAX_TURNS turns, and idle sessions expire after
+# SESSION_TTL seconds. Sessions are not shared between processes.
+
+MAX_SESSIONS = 10000
+MAX_TURNS = 20
+SESSION_TTL = 30 * 60
+
+
+class KeywordMatcher:
+    # Substring keywords with priorities given by their order. One compiled
+    # alternation finds every occurrence in a single scan: the lookahead lets
+    # matches overlap, and at each position the alternatives are tried in
+    # priority order, so the best match is the lowest index seen.
+
+    def __init__(self, entries):
+        self.entries = list(entries)
+        self.priority = {}
+        for i, (keyword, _) in enumerate(self.entries):
+            self.priority.setdefault(keyword, i)
+        keywords = sorted(self.priority, key=self.priority.get)
+        self.pattern = re.compile('(?=(' + '|'.join(re.escape(keyword) for keyword in keywords) + '))')
+
+    def match(self, text):
+        best = None
+        for match in self.pattern.finditer(text.lower()):
+            priority = self.priority[match.group(1)]
+            if best is None or priority < best:
+                best = priority
+                if best == 0:
+                    break
+
+        return self.entries[best][1] if best is not None else None
+
+
+DEFAULT_REPLY = "I'm here to help with your health questions. You can ask me about appointments, symptoms, medical records, or general health concerns."
+
+# Specific intents, highest priority first
+INTENTS = [
+    ('hello', 'Hello! How can I assist you with your health concerns today?'),
+    ('hi', 'Hi there! I\'m here to help with your medical questions.'),
+    ('appointment', 'You can schedule an appointment by going to the Appointments section and selecting a doctor.'),
+    ('book appointment', 'To book an appointment, visit the Appointments page and choose your preferred doctor and time slot.'),
+    ('symptoms', 'If you\'re experiencing symptoms, I can help recommend a specialist. Please describe your symptoms in detail.'),
+    ('pain', 'I\'m sorry to hear you\'re in pain. Can you describe the location and type of pain? For serious pain, please seek immediate medical attention.'),
+    ('fever', 'Fever can be a sign of infection. Please monitor your temperature and consult a doctor if it persists for more than 48 hours or is very high.'),
+    ('headache', 'Headaches can have various causes. If it\'s severe or persistent, I recommend consulting with Dr. James Wilson (Neurology).'),
+    ('records', 'You can view your medical records in the Medical Records section of your dashboard.'),
+    ('medical records', 'Your medical history is available in the Medical Records section. You can also add new records there.'),
+    ('prescription', 'For prescription refills, please contact your doctor directly or schedule an appointment.'),
+    ('medicine', 'Please consult with your doctor for medication-related questions. Never self-medicate without professional advice.'),
+    ('emergency', 'If this is a medical emergency, please call emergency services immediately or go to the nearest hospital.'),
+    ('help', 'I can help you with: booking appointments, finding doctors based on symptoms, accessing medical records, and answering general health questions.'),
+    ('thank', 'You\'re welcome! Is there anything else I can help you with?'),
+    ('bye', 'Goodbye! Take care of your health and don\'t hesitate to reach out if you need assistance.')
+]
+
+# General guidance when no specific intent matched; ranked after all of them
+TOPICS = [
+    (['doctor', 'specialist', 'expert'],
+     "I can help you find the right specialist based on your symptoms. Try using our AI doctor recommendation feature in the Appointments section."),
+    (['period', 'menstrual', 'cycle'],
+     "For menstrual cycle tracking and related concerns, please use our Period Tracker feature or consult with Dr. Lisa Patel (Gynecology)."),
+    (['test', 'lab', 'result'],
+     "You can view your lab test results in the Medical Records section. For new tests, please schedule an appointment with your doctor.")
+]
+
+INTENT_MATCHER = KeywordMatcher(INTENTS + [(word, reply) for words, reply in TOPICS for word in words])
+
+
+class Responder:
+    # `history` holds the session's earlier (message, reply) turns, oldest
+    # first
+
+    def stream(self, message, history=()):
+        raise NotImplementedError
+
+    def reply(self, message, history=()):
+        return ''.join(self.stream(message, history))
+
+
+class KeywordResponder(Responder):
+    def stream(self, message, history=()):
+        # The whole canned reply is ready at once
+        yield INTENT_MATCHER.match(message) or DEFAULT_REPLY
+
+
+RESPONDERS = {
+    'keyword': KeywordResponder
+}
+
+
+class ConversationStore:
+    def __init__(self, max_sessions=MAX_SESSIONS, max_turns=MAX_TURNS, ttl=SESSION_TTL):
+        self.max_sessions = max_sessions
+        self.max_turns = max_turns
+        self.ttl = ttl
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _expire(self, now):
+        # Sessions are kept in least recently used order
+        while self._sessions:
+            session_id, (_, last_used) = next(iter(self._sessions.items()))
+            if now - last_used < self.ttl and len(self._sessions) <= self.max_sessions:
+                break
+            del self._sessions[session_id]
+
+    def open(self, session_id=None):
+        # Unknown or expired ids get a fresh session rather than the id the
+        # client made up, so ids stay unguessable
+        with self._lock:
+            now = time.monotonic()
+            if isinstance(session_id, str) and session_id in self._sessions and now - self._sessions[session_id][1] < self.ttl:
+                self._sessions[session_id] = (self._sessions[session_id][0], now)
+                self._sessions.move_to_end(session_id)
+            else:
+                session_id = secrets.token_urlsafe(16)
+                self._sessions[session_id] = (deque(maxlen=self.max_turns), now)
+            self._expire(now)
+            return session_id
+
+    def history(self, session_id):
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            return list(entry[0]) if entry is not None else []
+
+    def cached_reply(self, session_id, message):
+        # Reply to the same question asked earlier in this session
+        for previous, reply in reversed(self.history(session_id)):
+            if previous == message:
+                return reply
+        return None
+
+    def record(self, session_id, message, reply):
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                # Expired while the reply was produced
+                return
+            entry[0].append((message, reply))
+            self._sessions[session_id] = (entry[0], time.monotonic())
+            self._sessions.move_to_end(session_id)
@@ -0,0 +1,189 @@
+import argparse
+import os
+import statistics
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from multiprocessing import Process, Queue
+
+from passwords import DEFAULT_COSTS
+
+# Load benchmarks for the MedilinkPro API.
+#
+#   python benchmark.py writes --processes 4 --threads 8 --requests 4000
+#   python benchmark.py login --scheme scrypt --costs 12 13 14 15
+#   python benchmark.py login --scheme pbkdf2_sha256
+#
+# writes: each worker process imports the app against a shared scratch data
+# directory (like separate gunicorn workers would) and fires concurrent
+# POST /api/appointments calls through the Flask test client. Afterwards the
+# data is reloaded from disk and checked for lost bookings and duplicate ids.
+#
+# login: for every password hashing cost, a fresh app registers a set of
+# users and then logs them in concurrently, reporting throughput and latency
+# so the cost can be chosen to fit the expected peak login rate. Without
+# --costs it tries costs around the scheme's default.
+
+
+def load_app(data_dir, storage):
+    os.environ['MEDILINK_DATA_DIR'] = data_dir
+    os.environ['MEDILINK_STORAGE'] = storage
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app
+    return app
+
+
+def write_worker(data_dir, storage, worker, threads, requests, results):
+    app = load_app(data_dir, storage)
+    client = app.app.test_client()
+
+    def book(n):
+        # Every request gets its own slot so none is rejected as a conflict
+        response = client.post('/api/appointments', json={
+            "patient_id": worker + 1,
+            "doctor_id": n % len(app.DOCTORS) + 1,
+            "date": (date(2100, 1, 1) + timedelta(days=worker * requests + n)).isoformat(),
+            "time": "09:00",
+            "reason": "stress test"
+        })
+        return response.status_code
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        statuses = list(pool.map(book, range(requests)))
+
+    app.store.close()
+    results.put(statuses)
+
+
+def bench_writes(args):
+    data_dir = tempfile.mkdtemp(prefix='medilink-bench-')
+    per_worker = args.requests // args.processes
+    results = Queue()
+
+    started = time.perf_counter()
+    workers = [Process(target=write_worker,
+                       args=(data_dir, args.storage, i, args.threads, per_worker, results))
+               for i in range(args.processes)]
+    for worker in workers:
+        worker.start()
+    statuses = [status for _ in workers for status in results.get()]
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+
+    app = load_app(data_dir, args.storage)
+    appointments = app.store.appointments.all()
+    ids = [apt['id'] for apt in appointments]
+
+    created = statuses.count(201)
+    print(f"{len(statuses)} creates from {args.processes} processes x {args.threads} threads "
+          f"in {elapsed:.2f}s ({len(statuses) / elapsed:.0f} req/s)")
+    print(f"  201 responses:      {created}")
+    print(f"  rows on disk:       {len(appointments)}")
+    print(f"  duplicate ids:      {len(ids) - len(set(ids))}")
+
+    app.store.close()
+    shutil.rmtree(data_dir)
+
+    if created != len(statuses) or len(appointments) != created or len(ids) != len(set(ids)):
+        print("FAILED: bookings were lost or ids collided")
+        return 1
+    print("OK: no bookings lost")
+    return 0
+
+
+def login_worker(data_dir, scheme, cost, users, threads, requests, results):
+    os.environ['MEDILINK_PASSWORD_HASH'] = scheme
+    os.environ['MEDILINK_PASSWORD_COST'] = str(cost)
+    app = load_app(data_dir, 'json')
+    client = app.app.test_client()
+
+    for n in range(users):
+        client.post('/api/register', json={
+            "name": f"User {n}", "email": f"user{n}@example.com", "password": f"secret-{n}",
+            "dob": "1990-01-01", "gender": "Other", "phone": "555-0100"
+        })
+
+    def login(n):
+        started = time.perf_counter()
+        response = client.post('/api/login', json={
+            "email": f"user{n % users}@example.com", "password": f"secret-{n % users}"
+        })
+        return response.status_code, time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        outcomes = list(pool.map(login, range(requests)))
+    elapsed = time.perf_counter() - started
+
+    app.deferred_users.close()
+    app.store.close()
+    results.put((outcomes, elapsed))
+
+
+def default_costs(scheme):
+    # scrypt costs are log2(N), so step by one; PBKDF2 costs are iteration
+    # counts, so step by doubling
+    cost = DEFAULT_COSTS[scheme]
+    if scheme == 'scrypt':
+        return [cost - 2, cost - 1, cost, cost + 1]
+    return [cost // 4, cost // 2, cost, cost * 2]
+
+
+def bench_login(args):
+    failed = False
+    print(f"{args.requests} logins of {args.users} users with {args.threads} threads, {args.scheme}")
+    for cost in args.costs or default_costs(args.scheme):
+        data_dir = tempfile.mkdtemp(prefix='medilink-bench-')
+        results = Queue()
+        worker = Process(target=login_worker,
+                         args=(data_dir, args.scheme, cost, args.users, args.threads, args.requests, results))
+        worker.start()
+        outcomes, elapsed = results.get()
+        worker.join()
+        shutil.rmtree(data_dir)
+
+        latencies = sorted(latency for _, latency in outcomes)
+        ok = sum(1 for status, _ in outcomes if status == 200)
+        p95 = latencies[int(len(latencies) * 0.95) - 1]
+        print(f"  cost {cost:>7}: {len(outcomes) / elapsed:8.1f} logins/s  "
+              f"p50 {statistics.median(latencies) * 1000:7.1f} ms  p95 {p95 * 1000:7.1f} ms  "
+              f"ok {ok}/{len(outcomes)}")
+        failed = failed or ok != len(outcomes)
+
+    if failed:
+        print("FAILED: some logins were rejected")
+        return 1
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='MedilinkPro load benchmarks')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    writes = subparsers.add_parser('writes', help='concurrent appointment creates')
+    writes.add_argument('--processes', type=int, default=4)
+    writes.add_argument('--threads', type=int, default=8)
+    writes.add_argument('--requests', type=int, default=4000)
+    writes.add_argument('--storage', choices=['json', 'sqlite'], default='json')
+    writes.set_defaults(run=bench_writes)
+
+    login = subparsers.add_parser('login', help='login throughput per password hashing cost')
+    login.add_argument('--scheme', choices=['scrypt', 'pbkdf2_sha256'], default='scrypt')
+    login.add_argument('--costs', type=int, nargs='+',
+                       help='log2 of the scrypt work factor, or PBKDF2 iterations '
+                            '(default: around the scheme\'s default cost)')
+    login.add_argument('--users', type=int, default=20)
+    login.add_argument('--threads', type=int, default=8)
+    login.add_argument('--requests', type=int, default=200)
+    login.set_defaults(run=bench_login)
+
+    args = parser.parse_args()
+    return args.run(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
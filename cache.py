@@ -0,0 +1,78 @@
+import threading
+from collections import OrderedDict
+
+
+# Response cache for the per-user read endpoints.
+#
+# Backends map string keys to bytes and need get(key), set(key, value) and
+# delete(*keys). MemoryCache is a size-bounded LRU private to the process;
+# RedisCache shares one cache between workers (eviction is then up to the
+# server's maxmemory-policy). create_cache() picks one by name.
+
+DEFAULT_SIZE = 4096
+
+
+class MemoryCache:
+    def __init__(self, size=DEFAULT_SIZE):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+
+class RedisCache:
+    def __init__(self, url='redis://localhost:6379/0', prefix='medilink:'):
+        # Optional dependency, only needed when this backend is selected
+        import redis
+
+        self.prefix = prefix
+        self._client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        return self._client.get(self.prefix + key)
+
+    def set(self, key, value):
+        self._client.set(self.prefix + key, value)
+
+    def delete(self, *keys):
+        if keys:
+            self._client.delete(*(self.prefix + key for key in keys))
+
+
+class NullCache:
+    def get(self, key):
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def delete(self, *keys):
+        pass
+
+
+def create_cache(backend, size=DEFAULT_SIZE, url=None):
+    if backend == 'memory':
+        return MemoryCache(size)
+    if backend == 'redis':
+        return RedisCache(url) if url else RedisCache()
+    if backend == 'none':
+        return NullCache()
+    raise ValueError(f'Unknown cache backend: {backend}')
@@ -0,0 +1,67 @@
+import base64
+import hashlib
+import hmac
+import os
+
+
+# Password hashing.
+#
+# Hashes are stored as "<scheme>$<cost>$<salt>$<hash>" with base64 salt and
+# hash, so the scheme and cost can change without invalidating existing
+# hashes: each one is verified with the parameters it was made with, and
+# needs_rehash() tells login to upgrade it. Values without a known scheme
+# prefix are legacy plaintext passwords.
+#
+# The cost is log2 of the scrypt work factor N, or the number of PBKDF2
+# iterations. Both hashlib functions release the GIL, so concurrent logins
+# hash in parallel; callers must not hold a store lock while hashing.
+
+SCHEMES = ('scrypt', 'pbkdf2_sha256')
+DEFAULT_COSTS = {'scrypt': 14, 'pbkdf2_sha256': 600000}
+SALT_SIZE = 16
+SCRYPT_R = 8
+SCRYPT_P = 1
+
+
+def _derive(scheme, cost, password, salt):
+    if scheme == 'scrypt':
+        n = 2 ** cost
+        return hashlib.scrypt(password.encode(), salt=salt, n=n, r=SCRYPT_R, p=SCRYPT_P,
+                              maxmem=256 * n * SCRYPT_R, dklen=32)
+    return hashlib.pbkdf2_hmac('sha256', password.encode(), salt, cost)
+
+
+class PasswordHasher:
+    def __init__(self, scheme='scrypt', cost=None):
+        if scheme not in SCHEMES:
+            raise ValueError(f'Unknown password hash scheme: {scheme}')
+        self.scheme = scheme
+        self.cost = cost if cost is not None else DEFAULT_COSTS[scheme]
+        self._dummy = None
+
+    def hash(self, password):
+        salt = os.urandom(SALT_SIZE)
+        derived = _derive(self.scheme, self.cost, password, salt)
+        return '$'.join([self.scheme, str(self.cost),
+                         base64.b64encode(salt).decode(), base64.b64encode(derived).decode()])
+
+    def verify(self, password, stored):
+        # `stored` may be None (no such user); the dummy hash keeps the
+        # response time the same so it doesn't reveal which emails exist
+        if stored is None:
+            if self._dummy is None:
+                self._dummy = self.hash('')
+            self.verify(password, self._dummy)
+            return False
+
+        parts = stored.split('$')
+        if len(parts) != 4 or parts[0] not in SCHEMES:
+            return hmac.compare_digest(stored.encode(), password.encode())
+
+        scheme, cost, salt, expected = parts
+        derived = _derive(scheme, int(cost), password, base64.b64decode(salt))
+        return hmac.compare_digest(derived, base64.b64decode(expected))
+
+    def needs_rehash(self, stored):
+        parts = stored.split('$')
+        return len(parts) != 4 or parts[0] != self.scheme or parts[1] != str(self.cost)
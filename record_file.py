@@ -0,0 +1,378 @@
+import hashlib
+import json
+import mmap
+import os
+import struct
+from contextlib import contextmanager
+
+from store import (COMPACT_AFTER, ID_BATCH, LOCK_EX, LOCK_SH, Collection, FileLock, IdAllocator,
+                   RWLock, add_sorted, remove_sorted, select_page)
+
+
+# Append-only record file for large, text-heavy collections (medical records).
+#
+# Rows are stored JSON-encoded in "<collection>.dat", which is memory-mapped
+# and decoded one row at a time on demand. "<collection>.idx" is an append-only
+# array of fixed-width entries (id, key, offset, length, flags) where the key
+# is the owning patient's id; the newest entry for an id wins and a deleted
+# flag tombstones it. Only the index is held in memory, so listing one
+# patient's records never decodes, or even pages in, anyone else's text.
+#
+# Locking follows store.Collection: an in-process reader/writer lock plus an
+# flock shared with other workers, who catch up by reading new index entries.
+# Every update appends a whole new copy of the row, so once `compact_after`
+# superseded entries have built up and they outnumber the live ones, the
+# write rewrites both files without them.
+#
+# The file is seeded from the JSON collection on first start, which is left
+# as it was and no longer updated.
+
+ENTRY = struct.Struct('<QqQII')
+DELETED = 1
+
+# Rows whose key isn't an int (e.g. a patient_id sent as a string) are stored
+# under this sentinel so they never match an integer lookup, as before.
+NO_KEY = -2 ** 63
+
+COMPACT_RATIO = 2
+
+
+class RecordFile:
+    def __init__(self, path, key_field, fsync=False, compact_after=COMPACT_AFTER, id_batch=ID_BATCH):
+        base = os.path.splitext(path)[0]
+        self.path = path
+        self.key_field = key_field
+        self.fsync = fsync
+        self.compact_after = compact_after
+        self.data_path = base + '.dat'
+        self.index_path = base + '.idx'
+
+        self._lock = RWLock()
+        self._file_lock = FileLock(base + '.lock')
+        self._ids = IdAllocator(base + '.seq', id_batch)
+
+        self._entries = {}
+        self._id_order = []
+        self._by_key = {}
+        self._max_id = 0
+        self._index_file = None
+        self._index_inode = None
+        self._index_size = 0
+        self._data_file = None
+        self._map = None
+
+        self.load()
+
+    # Locking
+
+    @contextmanager
+    def _reading(self):
+        if self._stale():
+            with self._lock.write(), self._file_lock(LOCK_SH):
+                self._sync()
+        with self._lock.read():
+            yield
+
+    @contextmanager
+    def _writing(self):
+        with self._lock.write(), self._file_lock(LOCK_EX):
+            self._sync(truncate=True)
+            yield
+            if self._index_size // ENTRY.size - len(self._entries) >= self.compact_after:
+                self._compact()
+
+    # Loading and catching up with other processes
+
+    def load(self):
+        # The JSON collection locks the same lock file, so it is read before
+        # taking ours
+        rows = None if os.path.exists(self.index_path) else self._collection_rows()
+        with self._lock.write(), self._file_lock(LOCK_EX):
+            if not os.path.exists(self.index_path):
+                self._import_rows(rows or [])
+            self._reload(truncate=True)
+
+    def _collection_rows(self):
+        # First start on this format: seed it from the JSON collection,
+        # including its binary snapshot and journal, without writing to it
+        base = os.path.splitext(self.path)[0]
+        if not any(os.path.exists(base + ext) for ext in ('.json', '.bin', '.log')):
+            return []
+        collection = Collection(self.path)
+        try:
+            return collection.all()
+        finally:
+            collection.close(compact=False)
+
+    def _import_rows(self, rows):
+        data = bytearray()
+        index = bytearray()
+        for row in rows:
+            encoded = self._encode(row)
+            index += ENTRY.pack(row['id'], self._row_key(row), len(data), len(encoded), 0)
+            data += encoded
+
+        self._replace_files(bytes(data), bytes(index))
+
+    def _replace_files(self, data, index):
+        # Data first: until the index is swapped nothing points into it
+        for path, content in ((self.data_path, data), (self.index_path, index)):
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(content)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+
+    def _reload(self, truncate=False):
+        self._entries = {}
+        self._id_order = []
+        self._by_key = {}
+        self._max_id = 0
+        self._index_size = 0
+
+        for handle in (self._index_file, self._data_file):
+            if handle is not None:
+                handle.close()
+        self._index_file = open(self.index_path, 'ab')
+        self._index_inode = os.fstat(self._index_file.fileno()).st_ino
+        self._data_file = open(self.data_path, 'ab')
+
+        self._read_index(truncate)
+        self._remap()
+
+    def _read_index(self, truncate=False):
+        with open(self.index_path, 'rb+' if truncate else 'rb') as f:
+            f.seek(self._index_size)
+            chunk = f.read()
+            usable = len(chunk) - len(chunk) % ENTRY.size
+            if truncate and usable != len(chunk):
+                # Torn entry from a crash mid-append
+                f.truncate(self._index_size + usable)
+
+        for entry in ENTRY.iter_unpack(chunk[:usable]):
+            self._apply(*entry)
+        self._index_size += usable
+
+    def _remap(self):
+        # Done under the file lock after every index read or write, so the
+        # mapping always covers every offset the in-memory index refers to,
+        # even if a compaction replaces the data file afterwards.
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        with open(self.data_path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _stale(self):
+        try:
+            st = os.stat(self.index_path)
+        except FileNotFoundError:
+            return True
+        return st.st_ino != self._index_inode or st.st_size != self._index_size
+
+    def _sync(self, truncate=False):
+        if not self._stale():
+            return
+
+        try:
+            st = os.stat(self.index_path)
+        except FileNotFoundError:
+            st = None
+        if st is None or st.st_ino != self._index_inode or st.st_size < self._index_size:
+            # Another process compacted the files
+            self._reload(truncate)
+        else:
+            self._read_index(truncate)
+            self._remap()
+
+    def _apply(self, row_id, key, offset, length, flags):
+        old = self._entries.get(row_id)
+        if old is not None and (flags & DELETED or old[0] != key):
+            del self._entries[row_id]
+            remove_sorted(self._id_order, row_id)
+            bucket = self._by_key[old[0]]
+            del bucket[row_id]
+            if not bucket:
+                del self._by_key[old[0]]
+
+        if flags & DELETED:
+            return
+
+        # Re-assigning an existing id keeps its position in both dicts
+        if row_id not in self._entries:
+            add_sorted(self._id_order, row_id)
+        self._entries[row_id] = (key, offset, length)
+        self._by_key.setdefault(key, {})[row_id] = None
+        self._max_id = max(self._max_id, row_id)
+
+    # Encoding
+
+    def _row_key(self, row):
+        key = row.get(self.key_field)
+        if isinstance(key, int) and not isinstance(key, bool):
+            return key
+        return NO_KEY
+
+    def _encode(self, row):
+        return json.dumps(row, separators=(',', ':')).encode()
+
+    def _decode(self, row_id):
+        _, offset, length = self._entries[row_id]
+        return json.loads(self._map[offset:offset + length])
+
+    # Reads
+
+    def __len__(self):
+        with self._reading():
+            return len(self._entries)
+
+    def all(self):
+        with self._reading():
+            return [self._decode(row_id) for row_id in self._entries]
+
+    def get(self, row_id):
+        with self._reading():
+            if row_id not in self._entries:
+                return None
+            return self._decode(row_id)
+
+    def find(self, field, value):
+        with self._reading():
+            if field == self.key_field:
+                if not isinstance(value, int) or isinstance(value, bool):
+                    return []
+                return [self._decode(row_id) for row_id in self._by_key.get(value, ())]
+
+            rows = (self._decode(row_id) for row_id in self._entries)
+            return [row for row in rows if row.get(field) == value]
+
+    def find_one(self, field, value):
+        rows = self.find(field, value)
+        return rows[0] if rows else None
+
+    def count(self, field, value):
+        if field != self.key_field:
+            return len(self.find(field, value))
+        with self._reading():
+            return len(self._by_key.get(value, ()))
+
+    def version(self, field, value):
+        # Digest of where the key's rows live in the data file; every write
+        # appends a new location, so any change yields a new version
+        with self._reading():
+            if field == self.key_field:
+                ids = sorted(self._by_key.get(value, ())) if isinstance(value, int) else []
+            else:
+                ids = [row_id for row_id in self._id_order if self._decode(row_id).get(field) == value]
+            digest = hashlib.blake2b(digest_size=16)
+            for row_id in ids:
+                digest.update(ENTRY.pack(row_id, *self._entries[row_id], 0))
+            return digest.hexdigest()
+
+    def page(self, field=None, value=None, after=None, limit=None, date_field=None,
+             start=None, end=None, fields=None):
+        with self._reading():
+            if field is None:
+                ids = self._id_order
+            elif field == self.key_field:
+                ids = sorted(self._by_key.get(value, ())) if isinstance(value, int) else []
+            else:
+                ids = [row_id for row_id in self._id_order if self._decode(row_id).get(field) == value]
+            return select_page(ids, self._decode, after, limit, date_field, start, end, fields)
+
+    # Writes
+
+    def next_id(self):
+        row_id = self._ids.allocate(floor=self._max_id + 1)
+        while row_id in self._entries:
+            row_id = self._ids.allocate(floor=self._max_id + 1)
+        return row_id
+
+    def _append(self, row_id, key, encoded=b'', flags=0):
+        offset = os.fstat(self._data_file.fileno()).st_size
+        if encoded:
+            self._data_file.write(encoded)
+            self._data_file.flush()
+
+        entry = ENTRY.pack(row_id, key, offset, len(encoded), flags)
+        self._index_file.write(entry)
+        self._index_file.flush()
+        if self.fsync:
+            os.fsync(self._data_file.fileno())
+            os.fsync(self._index_file.fileno())
+
+        self._apply(row_id, key, offset, len(encoded), flags)
+        self._index_size += len(entry)
+        if encoded:
+            self._remap()
+
+    def insert(self, row):
+        with self._writing():
+            row = {"id": self.next_id(), **row}
+            self._append(row['id'], self._row_key(row), self._encode(row))
+        return row
+
+    def update(self, row_id, changes):
+        with self._writing():
+            if row_id not in self._entries:
+                return None
+
+            row = dict(self._decode(row_id), **changes)
+            self._append(row_id, self._row_key(row), self._encode(row))
+            return row
+
+    def update_many(self, updates):
+        with self._writing():
+            count = 0
+            for row_id, changes in updates.items():
+                if row_id not in self._entries:
+                    continue
+                row = dict(self._decode(row_id), **changes)
+                self._append(row_id, self._row_key(row), self._encode(row))
+                count += 1
+            return count
+
+    def delete(self, row_id):
+        with self._writing():
+            if row_id not in self._entries:
+                return None
+
+            row = self._decode(row_id)
+            self._append(row_id, self._entries[row_id][0], flags=DELETED)
+            return row
+
+    def compact(self):
+        with self._writing():
+            self._compact()
+
+    def _compact(self):
+        if self._index_size <= len(self._entries) * ENTRY.size * COMPACT_RATIO:
+            return
+
+        data = bytearray()
+        index = bytearray()
+        for row_id, (key, offset, length) in self._entries.items():
+            index += ENTRY.pack(row_id, key, len(data), length, 0)
+            data += self._map[offset:offset + length]
+
+        self._replace_files(bytes(data), bytes(index))
+        self._reload()
+
+    def convert(self, snapshot_format):
+        # Snapshot formats don't apply; the record file is its own format
+        pass
+
+    def close(self):
+        if self._file_lock.closed:
+            return
+        self.compact()
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        for handle in (self._index_file, self._data_file):
+            if handle is not None:
+                handle.close()
+        self._ids.close()
+        self._file_lock.close()
@@ -0,0 +1,480 @@
+import json
+import os
+import sqlite3
+import threading
+import weakref
+
+from store import DuplicateKeyError, Store
+
+
+# SQLite storage backend.
+#
+# Mirrors the tables in medilinkpro.sql (translated to SQLite types, with the
+# extra columns the API stores such as doctor_name or last_login) and exposes
+# the same collection interface as store.Collection, so the routes work
+# unchanged on either backend. Every change is a single-row statement instead
+# of a rewrite of the whole collection.
+#
+# Triggers count the changes to each owner's rows (e.g. one patient's
+# appointments) in the versions table; being in the database, the counters
+# are shared by every worker.
+#
+# Each thread uses its own connection. Threaded servers start a thread per
+# request, so the app hands the connection back with release() when the
+# request ends; up to POOL_SIZE idle connections are kept for later threads
+# and the rest are closed.
+
+POOL_SIZE = 8
+
+VERSION_TRIGGER = """
+CREATE TRIGGER IF NOT EXISTS {table}_{field}_{event}_version AFTER {event} ON {table} BEGIN
+{statements}
+END;
+"""
+
+BUMP_VERSION = """
+    INSERT INTO versions (name, owner, version)
+        SELECT '{table}.{field}', {row}.{column}, 1 WHERE {row}.{column} IS NOT NULL
+        ON CONFLICT (name, owner) DO UPDATE SET version = version + 1;"""
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    email TEXT UNIQUE NOT NULL,
+    password TEXT NOT NULL,
+    dob TEXT,
+    gender TEXT,
+    phone TEXT,
+    address TEXT,
+    created_at TEXT,
+    updated_at TEXT,
+    last_login TEXT
+);
+
+CREATE TABLE IF NOT EXISTS appointments (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    patient_id INTEGER REFERENCES users(id),
+    doctor_id INTEGER,
+    doctor_name TEXT,
+    specialization TEXT,
+    date TEXT NOT NULL,
+    time TEXT NOT NULL,
+    reason TEXT,
+    status TEXT DEFAULT 'Scheduled',
+    created_at TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_appointments_patient ON appointments (patient_id);
+CREATE INDEX IF NOT EXISTS idx_appointments_slot ON appointments (doctor_id, date, time);
+
+CREATE TABLE IF NOT EXISTS medical_records (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    patient_id INTEGER REFERENCES users(id),
+    record_type TEXT NOT NULL,
+    description TEXT,
+    date TEXT NOT NULL,
+    doctor TEXT,
+    file_path TEXT,
+    created_at TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_medical_records_patient ON medical_records (patient_id);
+
+CREATE TABLE IF NOT EXISTS period_tracker (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER REFERENCES users(id),
+    start_date TEXT NOT NULL,
+    end_date TEXT NOT NULL,
+    cycle_length INTEGER,
+    symptoms TEXT,
+    notes TEXT,
+    created_at TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_period_tracker_user ON period_tracker (user_id);
+
+-- Per-owner change counters, bumped by the triggers of each indexed
+-- collection (see SqlCollection.version)
+CREATE TABLE IF NOT EXISTS versions (
+    name TEXT NOT NULL,
+    owner INTEGER NOT NULL,
+    version INTEGER NOT NULL,
+    PRIMARY KEY (name, owner)
+);
+
+CREATE TABLE IF NOT EXISTS notifications (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER REFERENCES users(id),
+    title TEXT NOT NULL,
+    message TEXT NOT NULL,
+    type TEXT DEFAULT 'General',
+    is_read INTEGER DEFAULT 0,
+    created_at TEXT
+);
+"""
+
+
+class Connection(sqlite3.Connection):
+    # Unlike sqlite3.Connection, a subclass can be weakly referenced
+    pass
+
+
+class Database:
+    def __init__(self, path, pool_size=POOL_SIZE):
+        self.path = path
+        self.pool_size = pool_size
+        self._local = threading.local()
+        self._idle = []
+        # Weak, so a connection left behind by a finished thread is closed
+        # when the thread's locals are freed
+        self._connections = weakref.WeakSet()
+        self._connections_lock = threading.Lock()
+
+        self.connection().executescript(SCHEMA)
+
+    def _connect(self):
+        # Autocommit mode; writes open their own transactions
+        conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False,
+                               factory=Connection)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA busy_timeout=5000')
+        return conn
+
+    def connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            with self._connections_lock:
+                conn = self._idle.pop() if self._idle else None
+            if conn is None:
+                conn = self._connect()
+                with self._connections_lock:
+                    self._connections.add(conn)
+            self._local.conn = conn
+        return conn
+
+    def release(self):
+        # Return this thread's connection to the pool, or close it if the
+        # pool is full
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            return
+        self._local.conn = None
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        with self._connections_lock:
+            if len(self._idle) < self.pool_size:
+                self._idle.append(conn)
+                return
+            self._connections.discard(conn)
+        conn.close()
+
+    def close(self):
+        with self._connections_lock:
+            for conn in list(self._connections):
+                conn.close()
+            self._connections = weakref.WeakSet()
+            self._idle = []
+        self._local = threading.local()
+
+
+class SqlCollection:
+    def __init__(self, db, table, columns, json_columns=(), unique=None, indexes=None):
+        self.db = db
+        self.table = table
+        self.columns = columns
+        self.json_columns = set(json_columns)
+        self.unique = unique or {}
+        self.indexes = indexes or {}
+
+        for field, fields in self.indexes.items():
+            for event, rows in (('INSERT', ['NEW']), ('UPDATE', ['OLD', 'NEW']), ('DELETE', ['OLD'])):
+                statements = ''.join(BUMP_VERSION.format(table=table, field=field, row=row, column=fields[0])
+                                     for row in rows)
+                db.connection().executescript(VERSION_TRIGGER.format(
+                    table=table, field=field, event=event, statements=statements))
+
+    def _to_row(self, record):
+        row = {}
+        for key in record.keys():
+            value = record[key]
+            if value is None:
+                continue
+            if key in self.json_columns:
+                value = json.loads(value)
+            row[key] = value
+        return row
+
+    def _to_params(self, row):
+        params = []
+        for column in self.columns:
+            value = row.get(column)
+            if column in self.json_columns and value is not None:
+                value = json.dumps(value)
+            params.append(value)
+        return params
+
+    def _where(self, field, value):
+        fields = self.unique.get(field) or self.indexes.get(field) or (field,)
+        values = value if len(fields) > 1 else (value,)
+        return ' AND '.join(f'{name} = ?' for name in fields), list(values)
+
+    def _select(self, where='', params=()):
+        sql = f'SELECT * FROM {self.table}'
+        if where:
+            sql += f' WHERE {where}'
+        rows = self.db.connection().execute(sql + ' ORDER BY id', params)
+        return [self._to_row(record) for record in rows]
+
+    def __len__(self):
+        return self.db.connection().execute(f'SELECT COUNT(*) FROM {self.table}').fetchone()[0]
+
+    def all(self):
+        return self._select()
+
+    def get(self, row_id):
+        rows = self._select('id = ?', [row_id])
+        return rows[0] if rows else None
+
+    def find(self, field, value):
+        return self._select(*self._where(field, value))
+
+    def find_one(self, field, value):
+        rows = self.find(field, value)
+        return rows[0] if rows else None
+
+    def page(self, field=None, value=None, after=None, limit=None, date_field=None,
+             start=None, end=None, fields=None):
+        conditions, params = [], []
+        if field is not None:
+            where, values = self._where(field, value)
+            conditions.append(where)
+            params += values
+        if after is not None:
+            conditions.append('id > ?')
+            params.append(after)
+        if date_field and start:
+            conditions.append(f'{date_field} >= ?')
+            params.append(start)
+        if date_field and end:
+            conditions.append(f'{date_field} <= ?')
+            params.append(end)
+
+        # Only fetch the projected columns; id is always needed for the cursor
+        columns = '*'
+        if fields:
+            selected = [column for column in self.columns if column in fields or column == 'id']
+            columns = ', '.join(selected)
+
+        sql = f'SELECT {columns} FROM {self.table}'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY id'
+        if limit is not None:
+            # One extra row tells us whether there is a next page
+            sql += ' LIMIT ?'
+            params.append(limit + 1)
+
+        rows = [self._to_row(record) for record in self.db.connection().execute(sql, params)]
+        next_cursor = None
+        if limit is not None and len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = rows[-1]['id']
+        if fields and 'id' not in fields:
+            rows = [{key: value for key, value in row.items() if key != 'id'} for row in rows]
+        return rows, next_cursor
+
+    def version(self, field, value):
+        row = self.db.connection().execute('SELECT version FROM versions WHERE name = ? AND owner = ?',
+                                           [f'{self.table}.{field}', value]).fetchone()
+        return str(row[0]) if row else '0'
+
+    def count(self, field, value):
+        where, params = self._where(field, value)
+        sql = f'SELECT COUNT(*) FROM {self.table} WHERE {where}'
+        return self.db.connection().execute(sql, params).fetchone()[0]
+
+    def _check_unique(self, row, current=None):
+        for name, fields in self.unique.items():
+            key = tuple(row.get(field) for field in fields)
+            if current is not None and key == tuple(current.get(field) for field in fields):
+                continue
+            where = ' AND '.join(f'{field} = ?' for field in fields)
+            sql = f'SELECT 1 FROM {self.table} WHERE {where} AND id IS NOT ? LIMIT 1'
+            if self.db.connection().execute(sql, list(key) + [row['id']]).fetchone():
+                raise DuplicateKeyError(name, key if len(fields) > 1 else key[0])
+
+    def _transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front, so the uniqueness
+        # check and the write are atomic across threads and processes.
+        conn = self.db.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        return conn
+
+    def insert(self, row):
+        # AUTOINCREMENT ids come from sqlite_sequence and are never reused
+        columns = [column for column in self.columns if column != 'id']
+        conn = self._transaction()
+        try:
+            self._check_unique(dict(row, id=None))
+            placeholders = ', '.join('?' for _ in columns)
+            cursor = conn.execute(f'INSERT INTO {self.table} ({", ".join(columns)}) VALUES ({placeholders})',
+                                  self._to_params(row)[1:])
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        return {"id": cursor.lastrowid, **row}
+
+    def update(self, row_id, changes):
+        conn = self._transaction()
+        try:
+            current = self.get(row_id)
+            if current is None:
+                conn.execute('ROLLBACK')
+                return None
+
+            row = dict(current, **changes)
+            self._check_unique(row, current)
+            assignments = ', '.join(f'{column} = ?' for column in self.columns)
+            conn.execute(f'UPDATE {self.table} SET {assignments} WHERE id = ?',
+                         self._to_params(row) + [row_id])
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        return row
+
+    def update_many(self, updates):
+        # One transaction for the whole batch
+        assignments = ', '.join(f'{column} = ?' for column in self.columns)
+        conn = self._transaction()
+        count = 0
+        try:
+            for row_id, changes in updates.items():
+                current = self.get(row_id)
+                if current is None:
+                    continue
+                row = dict(current, **changes)
+                self._check_unique(row, current)
+                conn.execute(f'UPDATE {self.table} SET {assignments} WHERE id = ?',
+                             self._to_params(row) + [row_id])
+                count += 1
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        return count
+
+    def delete(self, row_id):
+        conn = self._transaction()
+        try:
+            row = self.get(row_id)
+            if row is not None:
+                conn.execute(f'DELETE FROM {self.table} WHERE id = ?', [row_id])
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        return row
+
+    def import_rows(self, rows):
+        # One-off migration from the file-backed collection of the same name
+        conn = self._transaction()
+        try:
+            placeholders = ', '.join('?' for _ in self.columns)
+            conn.executemany(f'INSERT OR REPLACE INTO {self.table} ({", ".join(self.columns)}) VALUES ({placeholders})',
+                             [self._to_params(row) for row in rows])
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        return len(rows)
+
+    def compact(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class SqlStore:
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.db = Database(path)
+
+        self.users = SqlCollection(
+            self.db, 'users',
+            ['id', 'name', 'email', 'password', 'dob', 'gender', 'phone', 'address',
+             'created_at', 'updated_at', 'last_login'],
+            unique={"email": ("email",)})
+        self.appointments = SqlCollection(
+            self.db, 'appointments',
+            ['id', 'patient_id', 'doctor_id', 'doctor_name', 'specialization', 'date', 'time',
+             'reason', 'status', 'created_at'],
+            unique={"slot": ("doctor_id", "date", "time")},
+            indexes={"patient_id": ("patient_id",)})
+        self.medical_records = SqlCollection(
+            self.db, 'medical_records',
+            ['id', 'patient_id', 'record_type', 'description', 'date', 'doctor', 'file_path',
+             'created_at'],
+            indexes={"patient_id": ("patient_id",)})
+        self.period_tracker = SqlCollection(
+            self.db, 'period_tracker',
+            ['id', 'user_id', 'start_date', 'end_date', 'cycle_length', 'symptoms', 'notes',
+             'created_at'],
+            json_columns=['symptoms'],
+            indexes={"user_id": ("user_id",)})
+
+    def user_stats(self, user_id, today):
+        conn = self.db.connection()
+        counts = conn.execute('''
+            SELECT
+                (SELECT COUNT(*) FROM appointments WHERE patient_id = :id),
+                (SELECT COUNT(*) FROM appointments
+                    WHERE patient_id = :id AND status = 'Scheduled' AND date > :today),
+                (SELECT COUNT(*) FROM medical_records WHERE patient_id = :id),
+                (SELECT COUNT(*) FROM period_tracker WHERE user_id = :id)
+        ''', {"id": user_id, "today": today}).fetchone()
+
+        return {
+            "total_appointments": counts[0],
+            "upcoming_appointments": counts[1],
+            "total_records": counts[2],
+            "total_cycles": counts[3]
+        }
+
+    def doctor_bookings(self, start, end):
+        rows = self.db.connection().execute('''
+            SELECT doctor_id, COUNT(*) FROM appointments
+            WHERE status = 'Scheduled' AND date BETWEEN ? AND ?
+            GROUP BY doctor_id
+        ''', [start, end])
+        return dict(rows.fetchall())
+
+    def collections(self):
+        return [self.users, self.appointments, self.medical_records, self.period_tracker]
+
+    def import_json(self, data_dir):
+        # Load the file-backed store so journals are replayed and binary
+        # snapshots or a medical records file are read like the app would
+        records_file = os.path.exists(os.path.join(data_dir, 'medical_records.idx'))
+        source = Store(data_dir, records_storage='mmap' if records_file else 'json')
+        try:
+            counts = {}
+            for collection in self.collections():
+                rows = getattr(source, collection.table).all()
+                counts[collection.table] = collection.import_rows(rows)
+            return counts
+        finally:
+            source.close()
+
+    def release(self):
+        self.db.release()
+
+    def compact(self):
+        self.db.connection().execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,978 @@
+import bisect
+import hashlib
+import json
+import logging
+import marshal
+import os
+import threading
+from contextlib import contextmanager
+from itertools import islice
+
+try:
+    import fcntl
+except ImportError:
+    # No flock on Windows; collections are then only safe within one process
+    fcntl = None
+
+
+# Process-resident storage for the JSON collections.
+#
+# Each collection file is loaded once and served from memory. Rows keep a
+# cached JSON encoding so writing a snapshot only re-encodes the rows that
+# were touched; the file layout stays identical to json.dump(..., indent=2).
+#
+# In journal mode (the default) a mutation is appended as a single line to
+# "<collection>.log" instead of rewriting the snapshot. Once the log grows past
+# `compact_after` records it is rotated and folded into a fresh snapshot on a
+# background thread. On startup the snapshot is loaded and the logs replayed.
+#
+# Collections can declare unique hash indexes over one or more fields (e.g.
+# users by email) and non-unique ones (e.g. appointments by patient_id). They
+# are maintained on every mutation, including replay, so lookups through them
+# never scan the rows.
+#
+# Concurrency: within a process, reads share a collection and writes are
+# exclusive. Across processes (several gunicorn workers on one data
+# directory) writers serialize on an flock of "<collection>.lock" and every
+# reader first catches up on journal records appended by other processes;
+# snapshots are always written to a temp file and renamed into place.
+#
+# Ids come from a persisted per-collection sequence ("<collection>.seq").
+# Each process reserves a batch of ids at a time, so allocation is O(1),
+# never reuses the id of a deleted row and is safe with several workers.
+#
+# Snapshots can also be written in a compact binary format ("<collection>.bin",
+# marshal with a small header) that loads several times faster than indented
+# JSON. Whichever snapshot file was written last is the one that gets loaded;
+# if it can't be decoded (e.g. after a Python upgrade changed the marshal
+# format) loading fails rather than silently starting from older data.
+#
+# Listeners registered with watch() see every change a collection applies,
+# including journal records replayed from other workers, which lets derived
+# data such as UserStats be maintained incrementally instead of recomputed.
+#
+# version(field, value) is a digest of the rows under one key of a
+# non-unique index (e.g. one patient's appointments). It is cached until one
+# of those rows changes, and since it depends only on the data every worker
+# computes the same value, which makes it usable as an HTTP ETag.
+#
+# WriteBehind queues low-value field updates (e.g. last_login) in memory,
+# coalescing repeated updates of a row, and writes them with update_many()
+# in one batch per flush interval.
+
+COMPACT_AFTER = 1000
+ID_BATCH = 32
+WRITE_BEHIND_INTERVAL = 5
+
+SNAPSHOT_MAGIC = b'MLNK'
+SNAPSHOT_VERSION = 1
+
+LOCK_SH = fcntl.LOCK_SH if fcntl else None
+LOCK_EX = fcntl.LOCK_EX if fcntl else None
+
+
+def encode_row(row):
+    return json.dumps(row, indent=2).replace('\n', '\n  ')
+
+
+def encode_binary(rows):
+    return SNAPSHOT_MAGIC + bytes([SNAPSHOT_VERSION, marshal.version]) + marshal.dumps(rows)
+
+
+def decode_binary(data):
+    # marshal output is only guaranteed readable by the same format version
+    if data[:4] != SNAPSHOT_MAGIC or data[4:6] != bytes([SNAPSHOT_VERSION, marshal.version]):
+        raise ValueError("Unsupported binary snapshot")
+    return marshal.loads(data[6:])
+
+
+def write_atomic(path, data):
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'wb' if isinstance(data, bytes) else 'w') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def add_sorted(ids, row_id):
+    # Ids almost always arrive in increasing order, so append is the fast path
+    if not ids or row_id > ids[-1]:
+        ids.append(row_id)
+    else:
+        position = bisect.bisect_left(ids, row_id)
+        if position == len(ids) or ids[position] != row_id:
+            ids.insert(position, row_id)
+
+
+def remove_sorted(ids, row_id):
+    position = bisect.bisect_left(ids, row_id)
+    if position < len(ids) and ids[position] == row_id:
+        del ids[position]
+
+
+def project(row, fields):
+    if not fields:
+        return row
+    return {field: row[field] for field in fields if field in row}
+
+
+def select_page(ids, load, after=None, limit=None, date_field=None, start=None, end=None,
+                fields=None):
+    # Shared by the storage backends. `ids` is sorted ascending and `load`
+    # turns an id into its row. Returns (rows, next_cursor), where the cursor
+    # is the last id of this page if more matching rows follow.
+    position = bisect.bisect_right(ids, after) if after is not None else 0
+    rows = []
+    last_id = None
+    for row_id in islice(ids, position, None):
+        row = load(row_id)
+        if date_field:
+            value = row.get(date_field)
+            if start and (value is None or value < start):
+                continue
+            if end and (value is None or value > end):
+                continue
+        if limit is not None and len(rows) == limit:
+            return rows, last_id
+        rows.append(project(row, fields))
+        last_id = row_id
+    return rows, None
+
+
+class DuplicateKeyError(Exception):
+    def __init__(self, index, key):
+        super().__init__(f"Duplicate value for unique index {index}: {key!r}")
+        self.index = index
+        self.key = key
+
+
+class RWLock:
+    # Shared readers, one exclusive (re-entrant) writer. Waiting writers block
+    # new readers so a steady stream of GETs can't starve them.
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = None
+        self._writer_depth = 0
+        self._writers_waiting = 0
+
+    @contextmanager
+    def read(self):
+        me = threading.get_ident()
+        with self._cond:
+            nested = self._writer == me
+            if not nested:
+                while self._writer is not None or self._writers_waiting:
+                    self._cond.wait()
+                self._readers += 1
+        try:
+            yield
+        finally:
+            if not nested:
+                with self._cond:
+                    self._readers -= 1
+                    if not self._readers:
+                        self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer != me:
+                self._writers_waiting += 1
+                while self._writer is not None or self._readers:
+                    self._cond.wait()
+                self._writers_waiting -= 1
+                self._writer = me
+            self._writer_depth += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer_depth -= 1
+                if not self._writer_depth:
+                    self._writer = None
+                    self._cond.notify_all()
+
+
+class FileLock:
+    # flock of a lock file shared by every process using the collection.
+    # Re-entrant, but only ever taken by the thread holding the collection's
+    # in-process write lock, so the depth counter needs no lock of its own.
+
+    def __init__(self, path):
+        self._file = open(path, 'a')
+        self._depth = 0
+
+    @property
+    def closed(self):
+        return self._file.closed
+
+    @contextmanager
+    def __call__(self, mode):
+        if fcntl is None or self._depth:
+            self._depth += 1
+            try:
+                yield
+            finally:
+                self._depth -= 1
+            return
+
+        fcntl.flock(self._file.fileno(), mode)
+        self._depth += 1
+        try:
+            yield
+        finally:
+            self._depth -= 1
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+
+    def close(self):
+        self._file.close()
+
+
+class IdAllocator:
+    def __init__(self, path, batch=ID_BATCH):
+        self.path = path
+        self.batch = batch
+        self._next = 0
+        self._limit = 0
+        self._lock = threading.Lock()
+        self._file = open(path, 'a+')
+
+    def allocate(self, floor=1):
+        # `floor` is one past the highest id on disk; it repairs a missing or
+        # damaged sequence file when the next batch is reserved.
+        with self._lock:
+            if self._next >= self._limit:
+                self._reserve(floor)
+            row_id = self._next
+            self._next += 1
+            return row_id
+
+    def _reserve(self, floor):
+        if fcntl is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        try:
+            self._file.seek(0)
+            try:
+                start = int(self._file.read().strip() or 0)
+            except ValueError:
+                start = 0
+            start = max(start, floor)
+
+            self._file.seek(0)
+            self._file.truncate()
+            self._file.write(str(start + self.batch))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        finally:
+            if fcntl is not None:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+
+        self._next = start
+        self._limit = start + self.batch
+
+    def close(self):
+        self._file.close()
+
+
+class Collection:
+    def __init__(self, path, unique=None, indexes=None, journal=True, fsync=False,
+                 compact_after=COMPACT_AFTER, id_batch=ID_BATCH, snapshot_format='json'):
+        self.path = path
+        self.unique = unique or {}
+        self.indexes = indexes or {}
+        self.journal = journal
+        self.fsync = fsync
+        self.compact_after = compact_after
+
+        base = os.path.splitext(path)[0]
+        self.binary_path = base + '.bin'
+        self.snapshot_format = snapshot_format
+        self.snapshot_path = self.binary_path if snapshot_format == 'binary' else path
+        self.log_path = base + '.log'
+        self.rotated_log_path = self.log_path + '.compacting'
+
+        self.rows = {}
+        self._id_order = []
+        self._encoded = {}
+        self._unique_index = {}
+        self._multi_index = {}
+        self._versions = {}
+        self._lock = RWLock()
+        self._file_lock = FileLock(base + '.lock')
+        self._ids = IdAllocator(base + '.seq', id_batch)
+        self._max_id = 0
+        self._log = None
+        self._log_inode = None
+        self._log_offset = 0
+        self._log_records = 0
+        self._snapshot_stat = None
+        self._compaction = None
+        self._listeners = []
+
+        self.load()
+
+    # Locking
+
+    @contextmanager
+    def _reading(self):
+        if self._stale():
+            with self._lock.write(), self._file_lock(LOCK_SH):
+                self._sync()
+        with self._lock.read():
+            yield
+
+    @contextmanager
+    def _writing(self):
+        with self._lock.write(), self._file_lock(LOCK_EX):
+            self._sync(truncate=True)
+            yield
+
+    def reading(self):
+        # Up-to-date, consistent view for reading state kept by listeners
+        return self._reading()
+
+    def watch(self, listener):
+        # `listener` needs reset(rows) and changed(old, new); either row may
+        # be None for an insert or a delete.
+        with self._lock.write():
+            self._listeners.append(listener)
+            listener.reset(self.rows.values())
+
+    # Loading and catching up with other processes
+
+    def load(self):
+        with self._lock.write(), self._file_lock(LOCK_EX):
+            self._reload(recover=True)
+
+    def _read_snapshot(self):
+        snapshots = []
+        for path in (self.binary_path, self.path):
+            st = self._stat(path)
+            if st is not None:
+                snapshots.append((st[2], path))
+
+        for _, path in sorted(snapshots, reverse=True):
+            try:
+                if path == self.binary_path:
+                    with open(path, 'rb') as f:
+                        return decode_binary(f.read()), path
+                with open(path, 'r') as f:
+                    return json.load(f), path
+            except FileNotFoundError:
+                # Replaced by another process's conversion in the meantime
+                continue
+            except (ValueError, EOFError) as e:
+                raise ValueError(f'Cannot read snapshot {path}: {e}') from e
+        return [], None
+
+    def _reload(self, recover=False):
+        data, loaded_path = self._read_snapshot()
+
+        self.rows = {row['id']: row for row in data}
+        self._id_order = sorted(self.rows)
+        self._max_id = max(self.rows, default=0)
+        self._encoded = {}
+        self._unique_index = {name: {} for name in self.unique}
+        self._multi_index = {name: {} for name in self.indexes}
+        self._versions = {name: {} for name in self.indexes}
+        for row in self.rows.values():
+            self._index(None, row)
+        for listener in self._listeners:
+            listener.reset(self.rows.values())
+
+        if recover and loaded_path is None:
+            # No snapshot file at all yet (an unreadable one raised above)
+            write_atomic(self.snapshot_path, self._snapshot_data())
+        self._snapshot_stat = self._stat(self.snapshot_path)
+
+        if not self.journal:
+            return
+
+        if os.path.exists(self.rotated_log_path):
+            self._replay(self.rotated_log_path)
+            if recover:
+                # A leftover rotated log means a compaction never finished;
+                # fold it into the snapshot now so compaction can resume.
+                write_atomic(self.snapshot_path, self._snapshot_data())
+                os.remove(self.rotated_log_path)
+                self._snapshot_stat = self._stat(self.snapshot_path)
+
+        if self._log is not None:
+            self._log.close()
+        self._log = open(self.log_path, 'ab')
+        self._log_inode = os.fstat(self._log.fileno()).st_ino
+        self._log_records, self._log_offset = self._replay(self.log_path, truncate=recover)
+
+    def _stat(self, path):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def _stale(self):
+        if not self.journal:
+            return self._stat(self.snapshot_path) != self._snapshot_stat
+
+        st = self._stat(self.log_path)
+        return st is None or st[0] != self._log_inode or st[1] != self._log_offset
+
+    def _sync(self, truncate=False):
+        if not self._stale():
+            return
+
+        if not self.journal:
+            self._reload()
+            return
+
+        st = self._stat(self.log_path)
+        if st is None or st[0] != self._log_inode or st[1] < self._log_offset:
+            # Another process compacted and rotated the log
+            self._reload()
+        else:
+            # Writers hold the exclusive lock, so anything past a partial line
+            # was left by a crashed process and is safe to cut off.
+            count, self._log_offset = self._replay(self.log_path, self._log_offset, truncate)
+            self._log_records += count
+
+    def _replay(self, log_path, offset=0, truncate=False):
+        count = 0
+        try:
+            with open(log_path, 'rb+' if truncate else 'rb') as f:
+                f.seek(offset)
+                for line in f:
+                    try:
+                        record = json.loads(line) if line.endswith(b'\n') else None
+                    except ValueError:
+                        record = None
+                    if record is None:
+                        # Torn tail from a crash mid-append; drop it so new
+                        # records don't get glued onto the partial line.
+                        if truncate:
+                            f.truncate(offset)
+                        break
+                    self._apply(record)
+                    offset += len(line)
+                    count += 1
+        except FileNotFoundError:
+            pass
+        return count, offset
+
+    # Indexes
+
+    def _apply(self, record):
+        if record['op'] == 'put':
+            row = record['row']
+            old = self.rows.get(row['id'])
+            self.rows[row['id']] = row
+            if old is None:
+                add_sorted(self._id_order, row['id'])
+            self._max_id = max(self._max_id, row['id'])
+            self._encoded.pop(row['id'], None)
+            self._index(old, row)
+            for listener in self._listeners:
+                listener.changed(old, row)
+        elif record['op'] == 'delete':
+            old = self.rows.pop(record['id'], None)
+            if old is not None:
+                remove_sorted(self._id_order, record['id'])
+                self._index(old, None)
+                for listener in self._listeners:
+                    listener.changed(old, None)
+            self._encoded.pop(record['id'], None)
+
+    def _key(self, fields, row):
+        if len(fields) == 1:
+            return row.get(fields[0])
+        return tuple(row.get(field) for field in fields)
+
+    def _index(self, old, new):
+        for name, index in self._unique_index.items():
+            fields = self.unique[name]
+            if old is not None:
+                key = self._key(fields, old)
+                if index.get(key) is old:
+                    del index[key]
+            if new is not None:
+                key = self._key(fields, new)
+                if key is not None:
+                    index[key] = new
+
+        for name, index in self._multi_index.items():
+            fields = self.indexes[name]
+            old_key = self._key(fields, old) if old is not None else None
+            new_key = self._key(fields, new) if new is not None else None
+
+            # Buckets map id -> row; replacing a row under the same key keeps
+            # its position so per-key results stay in insertion order.
+            if old is not None and old_key != new_key:
+                bucket = index.get(old_key)
+                if bucket is not None:
+                    bucket.pop(old['id'], None)
+                    if not bucket:
+                        del index[old_key]
+            if new is not None:
+                index.setdefault(new_key, {})[new['id']] = new
+
+            versions = self._versions[name]
+            if old is not None:
+                versions.pop(old_key, None)
+            if new is not None:
+                versions.pop(new_key, None)
+
+    def _check_unique(self, row):
+        # Also fail on any unhashable index key now, before _write() touches
+        # the rows or indexes
+        for fields in [*self.unique.values(), *self.indexes.values()]:
+            hash(self._key(fields, row))
+
+        current = self.rows.get(row['id'])
+        for name, index in self._unique_index.items():
+            key = self._key(self.unique[name], row)
+            if current is not None and self._key(self.unique[name], current) == key:
+                # Unchanged key; don't trip over duplicates already on disk
+                continue
+            existing = index.get(key)
+            if existing is not None and existing['id'] != row['id']:
+                raise DuplicateKeyError(name, key)
+
+    # Reads. Rows are replaced rather than mutated on update, so the dicts
+    # handed out here stay consistent after the read lock is released.
+
+    def __len__(self):
+        with self._reading():
+            return len(self.rows)
+
+    def all(self):
+        with self._reading():
+            return list(self.rows.values())
+
+    def get(self, row_id):
+        with self._reading():
+            return self.rows.get(row_id)
+
+    def find(self, field, value):
+        with self._reading():
+            if field in self._multi_index:
+                return list(self._multi_index[field].get(value, {}).values())
+            return [row for row in self.rows.values() if row.get(field) == value]
+
+    def count(self, field, value):
+        with self._reading():
+            if field in self._multi_index:
+                return len(self._multi_index[field].get(value, ()))
+            return sum(1 for row in self.rows.values() if row.get(field) == value)
+
+    def version(self, field, value):
+        with self._reading():
+            versions = self._versions[field]
+            version = versions.get(value)
+            if version is None:
+                digest = hashlib.blake2b(digest_size=16)
+                for row_id in sorted(self._multi_index[field].get(value, ())):
+                    digest.update(self._encoding(row_id).encode())
+                version = versions[value] = digest.hexdigest()
+            return version
+
+    def find_one(self, field, value):
+        with self._reading():
+            if field in self._unique_index:
+                return self._unique_index[field].get(value)
+            return next((row for row in self.rows.values() if row.get(field) == value), None)
+
+    def page(self, field=None, value=None, after=None, limit=None, date_field=None,
+             start=None, end=None, fields=None):
+        with self._reading():
+            if field is None:
+                ids = self._id_order
+            elif field in self._multi_index:
+                ids = sorted(self._multi_index[field].get(value, ()))
+            else:
+                ids = sorted(row_id for row_id, row in self.rows.items() if row.get(field) == value)
+            return select_page(ids, self.rows.__getitem__, after, limit, date_field, start, end, fields)
+
+    # Writes
+
+    def next_id(self):
+        row_id = self._ids.allocate(floor=self._max_id + 1)
+        while row_id in self.rows:
+            # Only possible if the data was edited behind our back
+            row_id = self._ids.allocate(floor=self._max_id + 1)
+        return row_id
+
+    def insert(self, row):
+        # The id is assigned under the write lock so concurrent inserts,
+        # from this or any other process, can never be handed the same one.
+        with self._writing():
+            row = {"id": self.next_id(), **row}
+            self._check_unique(row)
+            self._write({"op": "put", "row": row})
+        return row
+
+    def update(self, row_id, changes):
+        with self._writing():
+            row = self.rows.get(row_id)
+            if row is None:
+                return None
+
+            row = dict(row, **changes)
+            self._check_unique(row)
+            self._write({"op": "put", "row": row})
+            return row
+
+    def update_many(self, updates):
+        # {row_id: changes} under one lock and with a single journal append;
+        # rows deleted in the meantime are skipped
+        with self._writing():
+            records = []
+            for row_id, changes in updates.items():
+                row = self.rows.get(row_id)
+                if row is None:
+                    continue
+                row = dict(row, **changes)
+                self._check_unique(row)
+                records.append({"op": "put", "row": row})
+            self._write(*records)
+            return len(records)
+
+    def delete(self, row_id):
+        with self._writing():
+            row = self.rows.get(row_id)
+            if row is None:
+                return None
+
+            self._write({"op": "delete", "id": row_id})
+            return row
+
+    def _write(self, *records):
+        if not records:
+            return
+        for record in records:
+            self._apply(record)
+
+        if not self.journal:
+            self.save()
+            return
+
+        data = b''.join((json.dumps(record, separators=(',', ':')) + '\n').encode()
+                        for record in records)
+        self._log.write(data)
+        self._log.flush()
+        if self.fsync:
+            os.fsync(self._log.fileno())
+
+        self._log_offset += len(data)
+        self._log_records += len(records)
+        if self._log_records >= self.compact_after:
+            self.compact(background=True)
+
+    def _encoding(self, row_id):
+        encoded = self._encoded.get(row_id)
+        if encoded is None:
+            encoded = self._encoded[row_id] = encode_row(self.rows[row_id])
+        return encoded
+
+    def _snapshot_text(self):
+        chunks = [self._encoding(row_id) for row_id in self.rows]
+
+        if not chunks:
+            return '[]'
+        return '[\n  ' + ',\n  '.join(chunks) + '\n]'
+
+    def _snapshot_data(self, snapshot_format=None):
+        if (snapshot_format or self.snapshot_format) == 'binary':
+            return encode_binary(list(self.rows.values()))
+        return self._snapshot_text()
+
+    def save(self):
+        with self._lock.write(), self._file_lock(LOCK_EX):
+            write_atomic(self.snapshot_path, self._snapshot_data())
+            self._snapshot_stat = self._stat(self.snapshot_path)
+
+    def convert(self, snapshot_format):
+        # Fold the journal into a snapshot in the given format and keep that
+        # format for this collection's later compactions. Converting to
+        # binary also re-exports the JSON file first, so an up-to-date copy
+        # that any Python version can read is left next to the newer .bin.
+        if self._compaction is not None:
+            self._compaction.join()
+        with self._writing():
+            if snapshot_format == 'binary':
+                write_atomic(self.path, self._snapshot_data('json'))
+            self.snapshot_format = snapshot_format
+            self.snapshot_path = self.binary_path if snapshot_format == 'binary' else self.path
+            write_atomic(self.snapshot_path, self._snapshot_data())
+            self._snapshot_stat = self._stat(self.snapshot_path)
+
+            if not self.journal:
+                return
+            # Everything logged so far is in the new snapshot; replacing the
+            # log also makes other processes reload from it.
+            self._log.close()
+            write_atomic(self.log_path, b'')
+            if os.path.exists(self.rotated_log_path):
+                os.remove(self.rotated_log_path)
+            self._log = open(self.log_path, 'ab')
+            self._log_inode = os.fstat(self._log.fileno()).st_ino
+            self._log_offset = 0
+            self._log_records = 0
+
+    def compact(self, background=False):
+        with self._writing():
+            if not self.journal or self._log_records == 0:
+                return
+            if os.path.exists(self.rotated_log_path):
+                # A compaction is already in flight in this or another process
+                return
+
+            # Rotate the log so new writes keep appending while the snapshot
+            # is written, and capture the snapshot text at the same instant.
+            self._log.close()
+            os.replace(self.log_path, self.rotated_log_path)
+            rotated_inode = self._log_inode
+            self._log = open(self.log_path, 'ab')
+            self._log_inode = os.fstat(self._log.fileno()).st_ino
+            self._log_offset = 0
+            self._log_records = 0
+            data = self._snapshot_data()
+
+        if background:
+            self._compaction = threading.Thread(target=self._finish_compaction,
+                                                args=(data, rotated_inode), daemon=True)
+            self._compaction.start()
+        else:
+            self._finish_compaction(data, rotated_inode)
+
+    def _finish_compaction(self, data, rotated_inode):
+        tmp_path = f'{self.snapshot_path}.{os.getpid()}.compact.tmp'
+        with open(tmp_path, 'wb' if isinstance(data, bytes) else 'w') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+        # Swapping the snapshot and dropping the rotated log must look atomic
+        # to other processes reloading under a shared lock.
+        with self._lock.write(), self._file_lock(LOCK_EX):
+            st = self._stat(self.rotated_log_path)
+            if st is None or st[0] != rotated_inode:
+                # A process starting up already folded our rotated log
+                os.remove(tmp_path)
+                return
+            os.replace(tmp_path, self.snapshot_path)
+            os.remove(self.rotated_log_path)
+            self._snapshot_stat = self._stat(self.snapshot_path)
+
+    def close(self, compact=True):
+        # compact=False leaves the files exactly as the last write left them
+        if self._file_lock.closed:
+            return
+        if self._compaction is not None:
+            self._compaction.join()
+        if compact:
+            self.compact()
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+        self._ids.close()
+        self._file_lock.close()
+
+
+class WriteBehind:
+    # Updates still queued when the process dies are lost; interval=0 writes
+    # each one through immediately instead. close() flushes what is left.
+
+    def __init__(self, collection, interval=WRITE_BEHIND_INTERVAL):
+        self.collection = collection
+        self.interval = interval
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._thread = None
+        if interval > 0:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def defer(self, row_id, changes):
+        if self.interval <= 0:
+            self.collection.update(row_id, changes)
+            return
+        with self._lock:
+            self._pending.setdefault(row_id, {}).update(changes)
+
+    def flush(self):
+        with self._lock:
+            updates, self._pending = self._pending, {}
+        if not updates:
+            return
+        try:
+            self.collection.update_many(updates)
+        except BaseException:
+            # Requeue under anything deferred since, which is newer
+            with self._lock:
+                for row_id, changes in updates.items():
+                    self._pending[row_id] = dict(changes, **self._pending.get(row_id, {}))
+            raise
+
+    def _run(self):
+        while not self._closed.wait(self.interval):
+            try:
+                self.flush()
+            except Exception:
+                logging.getLogger(__name__).exception('Deferred write failed; will retry')
+
+    def close(self):
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+
+class UserStats:
+    # Per-patient appointment totals plus a sorted list of the dates of
+    # their scheduled appointments, kept in step with the appointments
+    # collection. Counting upcoming appointments is then a bisect on ISO
+    # date strings rather than parsing every appointment's date.
+
+    def __init__(self):
+        self.totals = {}
+        self.scheduled = {}
+
+    def reset(self, rows):
+        self.totals = {}
+        self.scheduled = {}
+        for row in rows:
+            self._add(row)
+
+    def changed(self, old, new):
+        if old is not None:
+            self._remove(old)
+        if new is not None:
+            self._add(new)
+
+    def _add(self, row):
+        patient_id = row.get('patient_id')
+        self.totals[patient_id] = self.totals.get(patient_id, 0) + 1
+        if row.get('status') == 'Scheduled' and isinstance(row.get('date'), str):
+            bisect.insort(self.scheduled.setdefault(patient_id, []), row['date'])
+
+    def _remove(self, row):
+        patient_id = row.get('patient_id')
+        self.totals[patient_id] -= 1
+        if not self.totals[patient_id]:
+            del self.totals[patient_id]
+        if row.get('status') == 'Scheduled' and isinstance(row.get('date'), str):
+            dates = self.scheduled[patient_id]
+            del dates[bisect.bisect_left(dates, row['date'])]
+            if not dates:
+                del self.scheduled[patient_id]
+
+    def upcoming(self, patient_id, today):
+        # Dates after today; an appointment today has already started
+        dates = self.scheduled.get(patient_id, ())
+        return len(dates) - bisect.bisect_right(dates, today)
+
+
+class DoctorSchedule:
+    # Sorted dates of each doctor's scheduled appointments, kept in step with
+    # the appointments collection so counting a doctor's bookings in a date
+    # range is two bisects.
+
+    def __init__(self):
+        self.scheduled = {}
+
+    def reset(self, rows):
+        self.scheduled = {}
+        for row in rows:
+            self.changed(None, row)
+
+    def changed(self, old, new):
+        if old is not None and self._counts(old):
+            dates = self.scheduled[old['doctor_id']]
+            del dates[bisect.bisect_left(dates, old['date'])]
+            if not dates:
+                del self.scheduled[old['doctor_id']]
+        if new is not None and self._counts(new):
+            bisect.insort(self.scheduled.setdefault(new['doctor_id'], []), new['date'])
+
+    def _counts(self, row):
+        return row.get('status') == 'Scheduled' and isinstance(row.get('date'), str)
+
+    def booked(self, start, end):
+        counts = {}
+        for doctor_id, dates in self.scheduled.items():
+            count = bisect.bisect_right(dates, end) - bisect.bisect_left(dates, start)
+            if count:
+                counts[doctor_id] = count
+        return counts
+
+
+class Store:
+    def __init__(self, data_dir, journal=True, fsync=False, compact_after=COMPACT_AFTER,
+                 snapshot_format='json', records_storage='json'):
+        os.makedirs(data_dir, exist_ok=True)
+
+        options = {"journal": journal, "fsync": fsync, "compact_after": compact_after,
+                   "snapshot_format": snapshot_format}
+        self.users = Collection(os.path.join(data_dir, 'users.json'),
+                                unique={"email": ("email",)}, **options)
+        self.appointments = Collection(os.path.join(data_dir, 'appointments.json'),
+                                       unique={"slot": ("doctor_id", "date", "time")},
+                                       indexes={"patient_id": ("patient_id",)}, **options)
+        if records_storage == 'mmap':
+            # Keep free-text medical records on disk and decode them lazily
+            from record_file import RecordFile
+            self.medical_records = RecordFile(os.path.join(data_dir, 'medical_records.json'),
+                                              key_field='patient_id', fsync=fsync,
+                                              compact_after=compact_after)
+        else:
+            if os.path.exists(os.path.join(data_dir, 'medical_records.idx')):
+                logging.getLogger(__name__).warning(
+                    'medical_records.idx exists: medical records written with '
+                    'MEDILINK_RECORDS_STORAGE=mmap are not in the JSON collection')
+            self.medical_records = Collection(os.path.join(data_dir, 'medical_records.json'),
+                                              indexes={"patient_id": ("patient_id",)}, **options)
+        self.period_tracker = Collection(os.path.join(data_dir, 'period_tracker.json'),
+                                         indexes={"user_id": ("user_id",)}, **options)
+
+        self.stats = UserStats()
+        self.appointments.watch(self.stats)
+        self.schedule = DoctorSchedule()
+        self.appointments.watch(self.schedule)
+
+    def user_stats(self, user_id, today):
+        with self.appointments.reading():
+            total_appointments = self.stats.totals.get(user_id, 0)
+            upcoming_appointments = self.stats.upcoming(user_id, today)
+
+        return {
+            "total_appointments": total_appointments,
+            "upcoming_appointments": upcoming_appointments,
+            "total_records": self.medical_records.count('patient_id', user_id),
+            "total_cycles": self.period_tracker.count('user_id', user_id)
+        }
+
+    def doctor_bookings(self, start, end):
+        # Scheduled appointments per doctor between two ISO dates, inclusive
+        with self.appointments.reading():
+            return self.schedule.booked(start, end)
+
+    def collections(self):
+        return [self.users, self.appointments, self.medical_records, self.period_tracker]
+
+    def compact(self):
+        for collection in self.collections():
+            collection.compact()
+
+    def convert(self, snapshot_format):
+        for collection in self.collections():
+            collection.convert(snapshot_format)
+
+    def close(self):
+        for collection in self.collections():
+            collection.close()
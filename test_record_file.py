@@ -0,0 +1,98 @@
+import os
+
+from record_file import ENTRY, RecordFile
+from store import Collection
+
+
+# Recovery, compaction and cross-process catch-up of record_file.RecordFile.
+# A second RecordFile on the same path stands in for another worker.
+
+def open_records(path, **options):
+    return RecordFile(str(path / 'medical_records.json'), key_field='patient_id', **options)
+
+
+def descriptions(records, patient_id=None):
+    rows = records.all() if patient_id is None else records.find('patient_id', patient_id)
+    return [row['description'] for row in rows]
+
+
+def test_seeds_from_collection_without_writing_it(tmp_path):
+    collection = Collection(str(tmp_path / 'medical_records.json'))
+    collection.insert({"patient_id": 1, "description": "a"})
+    collection.insert({"patient_id": 2, "description": "b"})
+    collection.close()
+    collection = Collection(str(tmp_path / 'medical_records.json'))
+    collection.update(1, {"description": "journaled"})
+    collection.close(compact=False)
+    before = {name: (tmp_path / name).read_bytes()
+              for name in ('medical_records.json', 'medical_records.log')}
+
+    records = open_records(tmp_path)
+    assert descriptions(records) == ["journaled", "b"]
+    records.close()
+    for name, data in before.items():
+        assert (tmp_path / name).read_bytes() == data
+
+
+def test_torn_index_entry_is_truncated(tmp_path):
+    records = open_records(tmp_path)
+    records.insert({"patient_id": 1, "description": "a"})
+    records.close()
+    with open(tmp_path / 'medical_records.idx', 'ab') as f:
+        f.write(ENTRY.pack(2, 1, 0, 1, 0)[:10])
+
+    records = open_records(tmp_path)
+    assert descriptions(records) == ["a"]
+    assert os.path.getsize(tmp_path / 'medical_records.idx') == ENTRY.size
+    records.insert({"patient_id": 1, "description": "b"})
+    records.close()
+
+    records = open_records(tmp_path)
+    assert descriptions(records, 1) == ["a", "b"]
+    records.close()
+
+
+def test_reads_rows_appended_by_other_process(tmp_path):
+    first = open_records(tmp_path)
+    second = open_records(tmp_path)
+    first.insert({"patient_id": 1, "description": "a"})
+    assert descriptions(second, 1) == ["a"]
+
+    # The data file grew past the second process's mapping
+    first.insert({"patient_id": 1, "description": "b" * 100000})
+    first.update(1, {"description": "c"})
+    assert descriptions(second, 1) == ["c", "b" * 100000]
+    first.close()
+    second.close()
+
+
+def test_writes_compact_superseded_entries(tmp_path):
+    records = open_records(tmp_path, compact_after=10)
+    row = records.insert({"patient_id": 1, "description": "x" * 1000})
+    records.insert({"patient_id": 2, "description": "y"})
+    for i in range(100):
+        records.update(row['id'], {"description": str(i) * 1000})
+
+    assert os.path.getsize(tmp_path / 'medical_records.idx') <= 12 * ENTRY.size
+    assert os.path.getsize(tmp_path / 'medical_records.dat') < 20 * 3000
+    assert descriptions(records, 1) == ["99" * 1000]
+    records.close()
+
+
+def test_catches_up_after_other_process_compacts(tmp_path):
+    first = open_records(tmp_path, compact_after=5)
+    second = open_records(tmp_path)
+    row = first.insert({"patient_id": 1, "description": "a"})
+    assert descriptions(second) == ["a"]
+    inode = os.stat(tmp_path / 'medical_records.idx').st_ino
+
+    for i in range(10):
+        first.update(row['id'], {"description": f"v{i}"})
+    first.insert({"patient_id": 2, "description": "b"})
+    assert os.stat(tmp_path / 'medical_records.idx').st_ino != inode
+
+    assert descriptions(second) == ["v9", "b"]
+    second.delete(row['id'])
+    assert descriptions(first) == ["b"]
+    first.close()
+    second.close()
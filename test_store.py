@@ -0,0 +1,196 @@
+import os
+import threading
+
+import pytest
+
+from store import LOCK_EX, LOCK_SH, Collection, DuplicateKeyError, FileLock, RWLock, fcntl
+
+
+# Journal replay, compaction and cross-process catch-up of store.Collection.
+# A second Collection on the same path stands in for another worker, and
+# crash() drops one without the compaction close() would run.
+
+def open_users(path, **options):
+    return Collection(str(path / 'users.json'), unique={"email": ("email",)},
+                      indexes={"team": ("team",)}, **options)
+
+
+def crash(collection):
+    collection._log.close()
+    collection._ids.close()
+    collection._file_lock.close()
+
+
+def emails(collection):
+    return [row['email'] for row in collection.all()]
+
+
+def test_replay_after_torn_append(tmp_path):
+    users = open_users(tmp_path)
+    users.insert({"email": "a@x", "team": 1})
+    users.insert({"email": "b@x", "team": 1})
+    crash(users)
+    with open(tmp_path / 'users.log', 'ab') as f:
+        f.write(b'{"op":"put","row":{"id":3,"email":"c@')
+
+    users = open_users(tmp_path)
+    assert emails(users) == ["a@x", "b@x"]
+
+    # The torn tail was cut off, so the next record starts on its own line
+    users.insert({"email": "d@x", "team": 2})
+    crash(users)
+    users = open_users(tmp_path)
+    assert emails(users) == ["a@x", "b@x", "d@x"]
+    assert [row['email'] for row in users.find('team', 2)] == ["d@x"]
+    users.close()
+
+
+def test_restart_folds_unfinished_compaction(tmp_path):
+    users = open_users(tmp_path)
+    users.insert({"email": "a@x", "team": 1})
+    users._finish_compaction = lambda data, rotated_inode: None
+    users.compact()
+    users.insert({"email": "b@x", "team": 1})
+    crash(users)
+    assert os.path.exists(tmp_path / 'users.log.compacting')
+
+    users = open_users(tmp_path)
+    assert emails(users) == ["a@x", "b@x"]
+    assert not os.path.exists(tmp_path / 'users.log.compacting')
+    users.close()
+
+
+def test_compaction_finishing_after_restart(tmp_path):
+    first = open_users(tmp_path)
+    first.insert({"email": "a@x", "team": 1})
+    finish = first._finish_compaction
+    pending = []
+    first._finish_compaction = lambda *args: pending.append(args)
+    first.compact()
+
+    # Another worker starts while the snapshot is still being written and
+    # folds the rotated log itself, so the late snapshot is dropped
+    second = open_users(tmp_path)
+    second.insert({"email": "b@x", "team": 2})
+    finish(*pending[0])
+    assert emails(first) == ["a@x", "b@x"]
+
+    crash(first)
+    second.close()
+    third = open_users(tmp_path)
+    assert emails(third) == ["a@x", "b@x"]
+    assert not [name for name in os.listdir(tmp_path) if name.endswith('.tmp')]
+    third.close()
+
+
+def test_catches_up_with_other_process(tmp_path):
+    first = open_users(tmp_path)
+    second = open_users(tmp_path)
+    first.insert({"email": "a@x", "team": 1})
+    assert second.find_one('email', "a@x")['id'] == 1
+
+    row = second.insert({"email": "b@x", "team": 1})
+    assert row['id'] != 1
+    assert [row['email'] for row in first.find('team', 1)] == ["a@x", "b@x"]
+    first.close()
+    second.close()
+
+
+def test_unique_index_rollback(tmp_path):
+    users = open_users(tmp_path)
+    users.insert({"email": "a@x", "team": 1})
+    b = users.insert({"email": "b@x", "team": 1})
+
+    with pytest.raises(DuplicateKeyError):
+        users.insert({"email": "a@x", "team": 2})
+    with pytest.raises(DuplicateKeyError):
+        users.update(b['id'], {"email": "a@x"})
+    with pytest.raises(TypeError):
+        users.insert({"email": "c@x", "team": [1]})
+
+    def check(users):
+        assert emails(users) == ["a@x", "b@x"]
+        assert users.find_one('email', "b@x") == b
+        assert users.find('team', 2) == []
+        assert users.find_one('email', "c@x") is None
+
+    check(users)
+    crash(users)
+    users = open_users(tmp_path)
+    check(users)
+    users.close()
+
+
+def test_rwlock_writer_waits_for_readers():
+    lock = RWLock()
+    acquired = threading.Event()
+
+    def write():
+        with lock.write():
+            acquired.set()
+
+    with lock.read():
+        with lock.read():
+            writer = threading.Thread(target=write)
+            writer.start()
+            assert not acquired.wait(0.1)
+    assert acquired.wait(1)
+    writer.join()
+
+    # Re-entrant for the writing thread, reads included
+    with lock.write():
+        with lock.write():
+            with lock.read():
+                pass
+
+
+@pytest.mark.skipif(fcntl is None, reason='flock is not available')
+def test_file_lock_is_reentrant_and_exclusive(tmp_path):
+    path = str(tmp_path / 'users.lock')
+    lock = FileLock(path)
+    other = FileLock(path)
+
+    with lock(LOCK_EX):
+        with lock(LOCK_SH):
+            with pytest.raises(BlockingIOError):
+                fcntl.flock(other._file.fileno(), LOCK_SH | fcntl.LOCK_NB)
+    fcntl.flock(other._file.fileno(), LOCK_EX | fcntl.LOCK_NB)
+    fcntl.flock(other._file.fileno(), fcntl.LOCK_UN)
+    lock.close()
+    other.close()
+
+
+def test_unreadable_snapshot_is_not_overwritten(tmp_path):
+    users = open_users(tmp_path)
+    users.insert({"email": "a@x", "team": 1})
+    users.convert('binary')
+    users.close()
+
+    # As written by a Python with another marshal format
+    path = tmp_path / 'users.bin'
+    data = bytearray(path.read_bytes())
+    data[5] ^= 0xff
+    path.write_bytes(bytes(data))
+    with pytest.raises(ValueError):
+        open_users(tmp_path)
+    assert path.read_bytes() == bytes(data)
+
+
+def test_convert_keeps_format_and_json_copy(tmp_path):
+    users = open_users(tmp_path)
+    users.insert({"email": "a@x", "team": 1})
+    users.convert('binary')
+    users.insert({"email": "b@x", "team": 1})
+    users.close()
+
+    assert os.path.getsize(tmp_path / 'users.log') == 0
+    assert os.path.getmtime(tmp_path / 'users.bin') >= os.path.getmtime(tmp_path / 'users.json')
+    users = open_users(tmp_path)
+    assert emails(users) == ["a@x", "b@x"]
+    users.close()
+
+    # The JSON re-export holds everything up to the conversion
+    os.remove(tmp_path / 'users.bin')
+    users = open_users(tmp_path)
+    assert emails(users) == ["a@x"]
+    users.close()
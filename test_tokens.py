@@ -0,0 +1,125 @@
+import importlib
+import os
+
+import pytest
+
+from tokens import TokenSigner, load_key
+
+
+# Session tokens: TokenSigner itself, and authorize() through the routes.
+# The app reads its configuration at import, so it is imported once against
+# a scratch data directory.
+
+KEY = b'0' * 64
+
+
+def tamper(token):
+    # The same token with the last character of its signature changed
+    return token[:-1] + ('A' if token[-1] != 'A' else 'B')
+
+
+def test_verify_round_trip():
+    signer = TokenSigner(KEY)
+    assert signer.verify(signer.issue(7)) == 7
+
+
+def test_verify_rejects_forged_tokens():
+    token = TokenSigner(KEY).issue(7)
+    signature = token.partition('.')[2]
+    other = TokenSigner(b'1' * 64).issue(8)
+
+    signer = TokenSigner(KEY)
+    assert signer.verify(other) is None
+    assert signer.verify(other.partition('.')[0] + '.' + signature) is None
+    assert signer.verify(tamper(token)) is None
+
+
+def test_verify_rejects_expired_tokens():
+    assert TokenSigner(KEY).verify(TokenSigner(KEY, ttl=-1).issue(7)) is None
+
+
+@pytest.mark.parametrize('token', ['', '.', 'garbage', 'a.b.c', '%%%.%%%', 'é.é'])
+def test_verify_rejects_malformed_tokens(token):
+    assert TokenSigner(KEY).verify(token) is None
+
+
+def test_verify_rejects_signed_garbage():
+    signer = TokenSigner(KEY)
+    payload = 'bm90IGpzb24'
+    assert signer.verify(f'{payload}.{signer._sign(payload)}') is None
+
+
+def test_load_key_gives_up_on_empty_file(tmp_path, monkeypatch):
+    monkeypatch.setattr('tokens.KEY_WAIT_INTERVAL', 0)
+    path = tmp_path / 'secret.key'
+    path.touch()
+    with pytest.raises(RuntimeError):
+        load_key(str(path))
+
+    os.remove(path)
+    key = load_key(str(path))
+    assert load_key(str(path)) == key
+
+
+@pytest.fixture(scope='module')
+def app_module(tmp_path_factory):
+    data_dir = tmp_path_factory.mktemp('data')
+    for name in ('users', 'appointments', 'medical_records', 'period_tracker'):
+        (data_dir / f'{name}.json').write_text('[]')
+    os.environ.update(MEDILINK_DATA_DIR=str(data_dir), MEDILINK_PASSWORD_HASH='pbkdf2_sha256',
+                      MEDILINK_PASSWORD_COST='1000', MEDILINK_WRITE_BEHIND_INTERVAL='0',
+                      MEDILINK_CACHE='none')
+    return importlib.import_module('app')
+
+
+@pytest.fixture(scope='module')
+def accounts(app_module):
+    client = app_module.app.test_client()
+    tokens = {}
+    for name in ('ann', 'bob'):
+        client.post('/api/register', json={"name": name, "email": f"{name}@x", "password": "pw",
+                                           "dob": "2000-01-01", "gender": "F", "phone": "1"})
+        response = client.post('/api/login', json={"email": f"{name}@x", "password": "pw"})
+        tokens[name] = (response.json['user']['id'], response.json['token'])
+    return tokens
+
+
+def get_stats(app_module, user_id, token=None):
+    headers = {"Authorization": f"Bearer {token}"} if token is not None else {}
+    return app_module.app.test_client().get(f'/api/user-stats/{user_id}', headers=headers)
+
+
+def test_own_token_is_accepted(app_module, accounts):
+    user_id, token = accounts['ann']
+    assert get_stats(app_module, user_id, token).status_code == 200
+
+
+def test_bad_tokens_are_unauthorized(app_module, accounts):
+    user_id, token = accounts['ann']
+    expired = TokenSigner(app_module.tokens.key, ttl=-1).issue(user_id)
+    forged = TokenSigner(b'1' * 64).issue(user_id)
+
+    for bad in (expired, forged, tamper(token), 'garbage'):
+        response = get_stats(app_module, user_id, bad)
+        assert response.status_code == 401
+
+
+def test_other_users_token_is_forbidden(app_module, accounts):
+    ann_id, _ = accounts['ann']
+    _, bob_token = accounts['bob']
+    assert get_stats(app_module, ann_id, bob_token).status_code == 403
+
+    client = app_module.app.test_client()
+    response = client.post('/api/appointments', headers={"Authorization": f"Bearer {bob_token}"},
+                           json={"patient_id": ann_id, "doctor_id": 1, "date": "2040-01-01",
+                                 "time": "09:00", "reason": "x"})
+    assert response.status_code == 403
+
+
+def test_require_token(app_module, accounts, monkeypatch):
+    user_id, token = accounts['ann']
+    assert get_stats(app_module, user_id).status_code == 200
+
+    monkeypatch.setattr(app_module, 'REQUIRE_TOKEN', True)
+    assert get_stats(app_module, user_id).status_code == 401
+    assert get_stats(app_module, user_id, token).status_code == 200
@@ -0,0 +1,81 @@
+import base64
+import hashlib
+import hmac
+import json
+import os
+import time
+
+
+# Signed, stateless session tokens.
+#
+# A token is "<payload>.<signature>": the payload is base64url JSON with the
+# user id and expiry time, the signature an HMAC-SHA256 of it. Verifying one
+# needs only the key, no storage access. Every worker must share the key; it
+# comes from MEDILINK_SECRET_KEY or else from a key file in the data
+# directory, created on first use.
+
+DEFAULT_TTL = 24 * 60 * 60
+KEY_SIZE = 32
+KEY_WAIT_ATTEMPTS = 50
+KEY_WAIT_INTERVAL = 0.1
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+def load_key(path):
+    # O_EXCL makes the first worker's key win if several start together
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        pass
+    else:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(os.urandom(KEY_SIZE).hex().encode())
+            f.flush()
+            os.fsync(f.fileno())
+
+    for _ in range(KEY_WAIT_ATTEMPTS):
+        with open(path, 'rb') as f:
+            key = f.read().strip()
+        if key:
+            return key
+        # Created by another worker that hasn't written it yet
+        time.sleep(KEY_WAIT_INTERVAL)
+
+    raise RuntimeError(f'Secret key file {path} is empty; delete it to generate a new key '
+                       'or set MEDILINK_SECRET_KEY')
+
+
+class TokenSigner:
+    def __init__(self, key, ttl=DEFAULT_TTL):
+        self.key = key if isinstance(key, bytes) else key.encode()
+        self.ttl = ttl
+
+    def _sign(self, payload):
+        return _b64encode(hmac.new(self.key, payload.encode(), hashlib.sha256).digest())
+
+    def issue(self, user_id):
+        payload = _b64encode(json.dumps({"uid": user_id, "exp": int(time.time()) + self.ttl},
+                                        separators=(',', ':')).encode())
+        return f'{payload}.{self._sign(payload)}'
+
+    def verify(self, token):
+        # The user id the token was issued to, or None if it is forged,
+        # malformed or expired
+        payload, _, signature = token.partition('.')
+        if not hmac.compare_digest(signature.encode(), self._sign(payload).encode()):
+            return None
+        try:
+            claims = json.loads(_b64decode(payload))
+        except ValueError:
+            return None
+        if claims.get('exp', 0) < time.time():
+            return None
+        return claims.get('uid')